@@ -2,49 +2,61 @@
 
 import sqlite3
 import numpy as np
-import pandas as pd
 from tqdm import tqdm
 import argparse
 import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
 
 # Import from utils
 try:
-    from utils.database import get_readings_for_id, get_example_ids
-    from utils.algorithms import compute_negative_cusum
+    from utils.database import iter_readings_for_ids, get_example_ids, configure_bulk_write, \
+        ensure_blob_column, array_to_blob, readings_count_sql
+    from utils.algorithms import cusum_pipeline
+    from utils.parallel import bounded_map
 except ModuleNotFoundError:
-    from flatten.utils.database import get_readings_for_id, get_example_ids
-    from flatten.utils.algorithms import compute_negative_cusum
-
-def process_readings_with_corrected_algorithm(readings, k=0.0):
-    """Apply the corrected CUSUM algorithm"""
-    # Convert to SVG coordinates (as in gpt-combined approach)
-    width, height = 800, 400
-    margin = 50
-    plot_width = width - 2 * margin
-    plot_height = height - 2 * margin
-    
-    min_reading = min(readings)
-    max_reading = max(readings)
-    reading_range = max_reading - min_reading if max_reading != min_reading else 1
-    
-    # Convert to SVG coordinates
-    svg_y_vals = []
-    for idx, reading in enumerate(readings):
-        svg_y = margin + plot_height - (plot_height * (reading - min_reading) / reading_range)
-        svg_y_vals.append(svg_y)
-    
-    svg_y_vals = np.array(svg_y_vals)
-    
-    # Apply simple inversion on SVG coordinates
-    y_inv = np.max(svg_y_vals) - svg_y_vals
-    # Use pandas rolling for smoothing to match original implementation
-    y_smooth = pd.Series(y_inv).rolling(window=5, min_periods=1, center=True).mean().to_numpy()
-    cusum = compute_negative_cusum(y_smooth, k=k)
-    
-    return cusum
+    from flatten.utils.database import iter_readings_for_ids, get_example_ids, configure_bulk_write, \
+        ensure_blob_column, array_to_blob, readings_count_sql
+    from flatten.utils.algorithms import cusum_pipeline
+    from flatten.utils.parallel import bounded_map
+
+# Number of pending UPDATE rows flushed per executemany/commit
+UPDATE_BATCH_SIZE = 2000
+
+# Records handed to each worker process per task
+WORKER_CHUNKSIZE = 64
+
+# sqlite3 prepared-statement cache size (default is 128)
+CACHED_STATEMENTS = 256
+
+# SET clause for the wide cusum0-cusum43 layout
+_CUSUM_UPDATE_SETS = ", ".join(f"cusum{i} = ?" for i in range(44))
 
 # get_example_ids is now imported from utils.database
 
+def compute_record_cusum(item, k=0.0):
+    """Compute CUSUM for one (record_id, readings) pair
+
+    Module-level so it can be pickled for ProcessPoolExecutor workers.
+    Returns (record_id, reading_count, cusum, cusum_min, error); cusum is None
+    when the record has insufficient data or failed with error.
+    """
+    record_id, readings = item
+    if len(readings) < 10:
+        return record_id, len(readings), None, None, None
+    try:
+        cusum, cusum_min = cusum_pipeline(readings, k=k)
+        return record_id, len(readings), cusum, cusum_min, None
+    except Exception as e:
+        return record_id, len(readings), None, None, e
+
+def flush_updates(conn, update_query, rows):
+    """Write a batch of CUSUM rows in one explicit transaction"""
+    conn.execute("BEGIN")
+    conn.executemany(update_query, rows)
+    conn.execute("COMMIT")
+
 def main():
     parser = argparse.ArgumentParser(description='Apply corrected CUSUM algorithm to readings')
     parser.add_argument('--db', type=str, default="~/dbs/readings.db",
@@ -69,6 +81,10 @@ def main():
                        help='Sort by: "cusum" = CUSUM values, "id" = record ID (default: id)')
     parser.add_argument('--table', type=str, default='readings',
                        help='Table to process (default: readings)')
+    parser.add_argument('--workers', type=int, default=1,
+                       help='Number of worker processes for CUSUM computation (default: 1 = no multiprocessing)')
+    parser.add_argument('--cusum-blob', action='store_true',
+                       help='Store CUSUM values as a single float32 cusum_array BLOB instead of cusum0-cusum43')
 
     args = parser.parse_args()
     
@@ -79,32 +95,51 @@ def main():
     if not os.path.exists(args.output):
         os.makedirs(args.output)
     
-    conn = sqlite3.connect(args.db)
+    # Autocommit mode: UPDATE batches open their own transactions, and the
+    # single UPDATE text always hits the enlarged statement cache
+    conn = sqlite3.connect(args.db, isolation_level=None, cached_statements=CACHED_STATEMENTS)
+    configure_bulk_write(conn)
     cursor = conn.cursor()
     
     # Determine which IDs to process
-    if args.ids:
-        # Process specific IDs
-        in_use_ids = [int(x.strip()) for x in args.ids.split(',')]
-        print(f"Processing specific IDs: {in_use_ids}")
-    elif args.example_dataset:
-        # Use example dataset
-        in_use_ids = get_example_ids(conn)
-        print(f"Processing example dataset ({len(in_use_ids)} records)...")
+    if args.ids or args.example_dataset:
+        if args.ids:
+            # Process specific IDs
+            in_use_ids = [int(x.strip()) for x in args.ids.split(',')]
+            print(f"Processing specific IDs: {in_use_ids}")
+        else:
+            # Use example dataset
+            in_use_ids = get_example_ids(conn)
+            print(f"Processing example dataset ({len(in_use_ids)} records)...")
+
+        # Apply sorting
+        if args.sort_by == 'id':
+            in_use_ids.sort(reverse=(args.sort_order == 'down'))
+
+        # Apply limit if specified
+        if args.limit:
+            in_use_ids = in_use_ids[:args.limit]
+            print(f"Limited to {args.limit} records")
     else:
-        # Get all in_use records
-        cursor.execute(f"SELECT id FROM {args.table} WHERE in_use = 1")
+        # Get all in_use records; filtering, ordering and limit are applied by
+        # SQLite (ORDER BY id walks the primary key, LIMIT stops the scan early)
+        query = f"SELECT id FROM {args.table} WHERE in_use = 1"
+        if not args.limit:
+            # Records with too few readings are never updated, so do not fetch
+            # them. Skipped with --limit, which must still pick the first N
+            # in_use records; short ones are then skipped while processing
+            query += f" AND ({readings_count_sql()}) >= 10"
+        if args.sort_by == 'id':
+            query += f" ORDER BY id {'DESC' if args.sort_order == 'down' else 'ASC'}"
+        if args.limit:
+            query += f" LIMIT {int(args.limit)}"
+        cursor.execute(query)
         in_use_ids = [row[0] for row in cursor.fetchall()]
-        print(f"Processing all {len(in_use_ids)} in_use records from {args.table}...")
-    
-    # Apply sorting
-    if args.sort_by == 'id':
-        in_use_ids.sort(reverse=(args.sort_order == 'down'))
-    
-    # Apply limit if specified
-    if args.limit:
-        in_use_ids = in_use_ids[:args.limit]
-        print(f"Limited to {args.limit} records")
+        if args.limit:
+            print(f"Processing {len(in_use_ids)} in_use records from {args.table}...")
+            print(f"Limited to {args.limit} records")
+        else:
+            print(f"Processing all {len(in_use_ids)} in_use records with at least 10 readings from {args.table}...")
     
     print(f"Using k={args.k}, threshold={cusum_threshold}")
     print(f"Database: {args.db}")
@@ -112,51 +147,88 @@ def main():
     print(f"Sort by: {args.sort_by}, order: {args.sort_order}")
     print()
     
-    # Process each record
-    for record_id in tqdm(in_use_ids, desc="Processing records"):
-        try:
-            # Get readings
-            readings = get_readings_for_id(conn, record_id, table=args.table)
-
-            if len(readings) < 10:  # Skip if insufficient data
-                print(f"Skipping ID {record_id}: insufficient data ({len(readings)} readings)")
-                continue
-
-            # Apply corrected CUSUM algorithm with k parameter
-            cusum = process_readings_with_corrected_algorithm(readings, k=args.k)
-            cusum_min = cusum.min()
-
-            # Determine negative slope using specified threshold
-            negative_slope = 1 if cusum_min < cusum_threshold else 0
-
-            # Prepare CUSUM values for database (pad with None if needed)
-            cusum_values = list(cusum) + [None] * (44 - len(cusum))
-
-            # Update database with CUSUM values
-            cusum_columns = [f"cusum{i}" for i in range(44)]
-            cusum_placeholders = ", ".join(["?" for _ in range(44)])
-            cusum_updates = ", ".join([f"{col} = ?" for col in cusum_columns])
-
-            update_query = f"""
-            UPDATE {args.table}
-            SET {cusum_updates},
-                cusum_min_correct = ?,
-                cusum_negative_slope_correct = ?
-            WHERE id = ?
-            """
-
-            cursor.execute(update_query, cusum_values + [cusum_min, negative_slope, record_id])
-            
-        except Exception as e:
-            print(f"Error processing ID {record_id}: {e}")
+    # Loop invariants: resolve argparse values and build the UPDATE statement
+    # once so every batch reuses the same cached prepared statement
+    table = args.table
+    cusum_blob = args.cusum_blob
+    if cusum_blob:
+        ensure_blob_column(conn, table, 'cusum_array')
+        cusum_updates = "cusum_array = ?"
+    else:
+        cusum_updates = _CUSUM_UPDATE_SETS
+    update_query = f"""
+    UPDATE {table}
+    SET {cusum_updates},
+        cusum_min_correct = ?,
+        cusum_negative_slope_correct = ?
+    WHERE id = ?
+    """
+    pending = []
+    cusum_buf = [None] * 44
+
+    # Process each record (readings are fetched in batched SELECTs; CUSUM
+    # computation optionally fans out to worker processes while this process
+    # remains the only SQLite reader/writer)
+    id_readings = iter_readings_for_ids(conn, in_use_ids, table=table, dtype=np.float64)
+    worker = partial(compute_record_cusum, k=args.k)
+    executor = ProcessPoolExecutor(max_workers=args.workers) if args.workers > 1 else None
+    if executor:
+        # At most two chunks per worker in flight, so readings keep streaming
+        # from the batched SELECTs while earlier results are written
+        results = bounded_map(executor, worker, id_readings, window=2 * args.workers,
+                              chunksize=WORKER_CHUNKSIZE)
+    else:
+        results = map(worker, id_readings)
+
+    # Throttle progress bar refreshes and skip rendering when stderr is not a terminal
+    progress = tqdm(results, total=len(in_use_ids), desc="Processing records",
+                    mininterval=0.5, miniters=1000, disable=not sys.stderr.isatty())
+    error_count = 0
+    for record_id, reading_count, cusum, cusum_min, error in progress:
+        if error is not None:
+            error_count += 1
+            print(f"Error processing ID {record_id}: {error}")
             continue
-    
-    # Commit changes
-    conn.commit()
+
+        if cusum is None:  # Skip if insufficient data
+            print(f"Skipping ID {record_id}: insufficient data ({reading_count} readings)")
+            continue
+
+        # Determine negative slope using specified threshold
+        negative_slope = 1 if cusum_min < cusum_threshold else 0
+
+        if cusum_blob:
+            # Single float32 BLOB, no padding needed
+            pending.append((array_to_blob(cusum), cusum_min, negative_slope, record_id))
+        else:
+            # Fill the reusable 44-slot buffer (None-padded) and snapshot it as a tuple
+            n = len(cusum)
+            cusum_buf[:n] = cusum.tolist()
+            if n < 44:
+                cusum_buf[n:] = [None] * (44 - n)
+            pending.append((*cusum_buf, cusum_min, negative_slope, record_id))
+
+        if len(pending) >= UPDATE_BATCH_SIZE:
+            flush_updates(conn, update_query, pending)
+            pending.clear()
+
+    if executor:
+        executor.shutdown()
+
+    # Flush remaining updates
+    if pending:
+        flush_updates(conn, update_query, pending)
     
     # Summary statistics for processed records only
     if in_use_ids:
-        placeholders = ','.join(['?'] * len(in_use_ids))
+        # Join against a temp table of processed ids rather than binding one
+        # placeholder per id (which breaks past SQLite's variable limit)
+        cursor.execute("DROP TABLE IF EXISTS temp.processed_ids")
+        cursor.execute("CREATE TEMP TABLE processed_ids (id INTEGER PRIMARY KEY)")
+        cursor.execute("BEGIN")
+        cursor.executemany("INSERT OR IGNORE INTO processed_ids (id) VALUES (?)",
+                           ((record_id,) for record_id in in_use_ids))
+        cursor.execute("COMMIT")
         cursor.execute(f"""
         SELECT
             COUNT(*) as total_processed,
@@ -164,13 +236,16 @@ def main():
             MIN(cusum_min_correct) as min_cusum,
             MAX(cusum_min_correct) as max_cusum,
             AVG(cusum_min_correct) as avg_cusum
-        FROM {args.table}
-        WHERE id IN ({placeholders}) AND in_use = 1 AND cusum_min_correct IS NOT NULL
-        """, in_use_ids)
+        FROM {table}
+        JOIN processed_ids USING (id)
+        WHERE in_use = 1 AND cusum_min_correct IS NOT NULL
+        """)
         
         stats = cursor.fetchone()
         print(f"\nProcessing complete!")
         print(f"Total processed: {stats[0]}")
+        if error_count:
+            print(f"Records with errors: {error_count}")
         print(f"Records with negative slopes: {stats[1]}")
         if stats[2] is not None and stats[3] is not None:
             try:
@@ -8,194 +8,369 @@ Includes top N samples with largest ranking disagreements per target for detaile
 
 import sqlite3
 import argparse
+import hashlib
+import os
+import pickle
+import queue
 import sys
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache, partial
+from itertools import groupby
+from operator import itemgetter
 from pathlib import Path
 
-
-def get_readings_for_id(conn, original_id, source_table):
-    """Get readings for a specific record from all_readings table"""
-    cursor = conn.cursor()
-    readings_columns = [f"readings{i}" for i in range(44)]
-    readings_select = ", ".join(readings_columns)
-    cursor.execute(f"SELECT {readings_select} FROM all_readings WHERE original_id = ? AND source_table = ?", (original_id, source_table))
-    row = cursor.fetchone()
-    if not row:
-        return []
-    readings = [r for r in row if r is not None]
-    return readings
+import numpy as np
+
+# Import from utils
+try:
+    from utils.database import connect_read_only
+    from utils.parallel import bounded_map
+except ModuleNotFoundError:
+    from flatten.utils.database import connect_read_only
+    from flatten.utils.parallel import bounded_map
+
+# Classification labels and curve colors keyed by effective cls (0=NEG, 1=POS, 2=EQUIV);
+# looked up with .get so NULL or unexpected values fall back to 'N/A' / grey
+_CLS_LABELS = {0: 'NEG', 1: 'POS', 2: 'EQUIV'}
+_CLS_COLORS = {0: '#2ecc71', 1: '#e74c3c', 2: '#f39c12'}  # Green negative, red positive, orange ambiguous
+
+# Mix-target groups buffered between the fetch thread and the HTML writer
+GROUP_QUEUE_SIZE = 4
+_END_OF_GROUPS = object()
+
+# readings0-readings43 column list selected alongside each comparison record
+# (a single readings BLOB column would shrink this, but all_readings keeps the wide layout)
+_READINGS_SELECT = ", ".join(f"readings{i}" for i in range(44))
+
+# Per-graph markup, filled with one %-substitution and emitted as a single line:
+# header, shared grid from generate_grid_defs, main curve, y-axis max/min labels
+_SVG_TMPL = (
+    '<div class="graph-container"><div class="graph-header">%s</div>'
+    '<svg width="%d" height="%d" style="background: white;">'
+    '<use href="#grid-%dx%d"/>'
+    '<polyline points="%s" fill="none" stroke="%s" stroke-width="2"/>'
+    '<text x="%d" y="%d" text-anchor="end" font-size="10" fill="#666">%.0f</text>'
+    '<text x="%d" y="%d" text-anchor="end" font-size="10" fill="#666">%.0f</text>'
+    '</svg></div>'
+)
+
+def build_combination_filter(include_ic=True, mixes=None):
+    """Build the shared IC / mixes WHERE fragment and its parameters"""
+    ic_filter = "" if include_ic else "AND MixTarget != 'IC'"
+    if mixes:
+        mixes = sorted(mixes)
+        mix_filter = f"AND Mix IN ({','.join('?' * len(mixes))})"
+        return f"{ic_filter} {mix_filter}", mixes
+    return ic_filter, []
 
 
-def get_azure_records_with_ar(conn, mix, mixtarget, limit=None):
+def get_azure_records_with_ar(conn, limit=None, include_ic=True, mixes=None):
     """
-    Get records with both Azure and AR data for a mix-target, sorted by ranking disagreement.
-    Uses all_readings table exclusively.
+    Get records with both Azure and AR data for every mix-target, sorted by ranking disagreement.
+    Uses all_readings table exclusively, in a single query grouped by Mix and MixTarget.
 
-    Returns list of tuples:
+    Yields (mix, mixtarget, records) per combination, where records is a list of tuples:
     (original_id, Sample, File, AzureCls, AzureCFD, azure_order, ar_cls, ar_cfd, ar_order,
-     source_table, azure_cls_label, ar_cls_label)
+     source_table, azure_cls_label, ar_cls_label, rank_diff, readings)
     """
     cursor = conn.cursor()
-
-    # Build query to get records with both Azure and AR data from all_readings, sorted by ranking disagreement
-    query = """
-    SELECT
+    combination_filter, params = build_combination_filter(include_ic, mixes)
+
+    # Build query to get records with both Azure and AR data from all_readings, sorted by ranking disagreement.
+    # Readings come back on the same row so no per-record lookup is needed; the
+    # per-combination limit is applied with ROW_NUMBER().
+    columns = f"""
+        Mix,
+        MixTarget,
         original_id,
         Sample,
         File,
-        AzureCls,
+        CASE WHEN AzureAmb = 1 THEN 2 ELSE AzureCls END AS azure_cls_calc,
         AzureCFD,
         azure_order,
-        ar_cls,
+        CASE WHEN ar_amb = 1 THEN 2 ELSE ar_cls END AS ar_cls_calc,
         ar_cfd,
         ar_order,
         source_table,
-        AzureAmb,
-        ar_amb,
-        ABS(azure_order - ar_order) as rank_diff
-    FROM all_readings
-    WHERE Mix = ? AND MixTarget = ?
-      AND AzureCFD IS NOT NULL AND ar_cfd IS NOT NULL
-      AND azure_order IS NOT NULL AND ar_order IS NOT NULL
-      AND in_use = 1
-    ORDER BY rank_diff DESC
+        rank_diff,
+        {_READINGS_SELECT}"""
+    query = f"""
+    SELECT {columns}
+    FROM (
+        SELECT
+            *,
+            ABS(azure_order - ar_order) as rank_diff,
+            ROW_NUMBER() OVER (PARTITION BY Mix, MixTarget ORDER BY ABS(azure_order - ar_order) DESC) AS rn
+        FROM all_readings
+        WHERE AzureCFD IS NOT NULL AND ar_cfd IS NOT NULL
+          AND azure_order IS NOT NULL AND ar_order IS NOT NULL
+          AND in_use = 1
+          {combination_filter}
+    )
+    {"WHERE rn <= ?" if limit else ""}
+    ORDER BY Mix, MixTarget, rank_diff DESC
     """
-
     if limit:
-        query += f" LIMIT {limit}"
-
-    cursor.execute(query, (mix, mixtarget))
-
-    records = []
-    for row in cursor.fetchall():
-        orig_id, sample, file, azure_cls, azure_cfd, azure_order, ar_cls, ar_cfd, ar_order, source_table, azure_amb, ar_amb, rank_diff = row
+        params.append(limit)
 
-        # Convert classifications to labels
-        cls_labels = {0: 'NEG', 1: 'POS', 2: 'EQUIV', None: 'N/A'}
+    cursor.execute(query, params)
 
-        # Determine Azure classification (amb overrides cls)
-        if azure_amb == 1:
-            azure_cls_calc = 2
-        else:
-            azure_cls_calc = azure_cls
-        azure_cls_label = cls_labels.get(azure_cls_calc, 'N/A')
+    for (mix, mixtarget), rows in groupby(cursor, key=itemgetter(0, 1)):
+        records = []
+        for row in rows:
+            # Effective classifications (amb overrides cls) are computed by SQLite
+            orig_id, sample, file, azure_cls_calc, azure_cfd, azure_order, ar_cls_calc, ar_cfd, ar_order, source_table, rank_diff = row[2:-44]
+            readings = [r for r in row[-44:] if r is not None]
 
-        # Determine AR classification (amb overrides cls)
-        if ar_amb == 1:
-            ar_cls_calc = 2
-        else:
-            ar_cls_calc = ar_cls
-        ar_cls_label = cls_labels.get(ar_cls_calc, 'N/A')
+            azure_cls_label = _CLS_LABELS.get(azure_cls_calc, 'N/A')
+            ar_cls_label = _CLS_LABELS.get(ar_cls_calc, 'N/A')
 
-        records.append((
-            orig_id, sample, file, azure_cls_calc, azure_cfd, azure_order,
-            ar_cls_calc, ar_cfd, ar_order, source_table,
-            azure_cls_label, ar_cls_label
-        ))
+            records.append((
+                orig_id, sample, file, azure_cls_calc, azure_cfd, azure_order,
+                ar_cls_calc, ar_cfd, ar_order, source_table,
+                azure_cls_label, ar_cls_label, rank_diff, readings
+            ))
 
-    return records
+        yield mix, mixtarget, records
 
 
-def get_classification_change_records(conn, mix, mixtarget, exclude_changes=None, limit=None):
+def get_classification_change_records(conn, exclude_changes=None, limit=None, include_ic=True, mixes=None):
     """
-    Get records where classification changed between Azure and AR.
+    Get records where classification changed between Azure and AR for every mix-target.
     Excludes rows where either AzureCls, AzureAmb, ar_cls, or ar_amb are NULL.
 
     Args:
         conn: Database connection
-        mix: Mix name
-        mixtarget: MixTarget name
         exclude_changes: List of change types to exclude (e.g., ['pos->neg', 'neg->pos'])
         limit: Maximum number of records per change type to return
+        include_ic: Include IC targets
+        mixes: Set of mix names to include (default: None = all mixes)
 
-    Returns list of tuples:
+    Yields (mix, mixtarget, records) per combination, where records is a list of tuples:
     (original_id, Sample, File, AzureCls, AzureCFD, AzureAmb, ar_cls, ar_cfd, ar_amb,
-     source_table, azure_cls_label, ar_cls_label, change_type, cfd_diff)
+     source_table, azure_cls_label, ar_cls_label, change_type, cfd_diff, readings)
     """
     cursor = conn.cursor()
-
-    # Query with all four columns NOT NULL
-    query = """
+    combination_filter, params = build_combination_filter(include_ic, mixes)
+
+    # Query with all four columns NOT NULL; readings are selected alongside.
+    # Effective classification (amb=1 overrides cls), labels, change type,
+    # exclusion, the per-change-type limit and ordering are all evaluated by SQLite.
+    exclude_list = sorted(exclude_changes) if exclude_changes else []
+    exclude_filter = f"AND change_type NOT IN ({','.join('?' * len(exclude_list))})" if exclude_list else ""
+    query = f"""
+    WITH effective AS (
+        SELECT
+            Mix,
+            MixTarget,
+            original_id,
+            Sample,
+            File,
+            CASE WHEN AzureAmb = 1 THEN 2 ELSE AzureCls END AS azure_cls_calc,
+            AzureCFD,
+            AzureAmb,
+            CASE WHEN ar_amb = 1 THEN 2 ELSE ar_cls END AS ar_cls_calc,
+            ar_cfd,
+            ar_amb,
+            source_table,
+            ABS(AzureCFD - ar_cfd) AS cfd_diff,
+            {_READINGS_SELECT}
+        FROM all_readings
+        WHERE AzureCls IS NOT NULL AND AzureAmb IS NOT NULL
+          AND ar_cls IS NOT NULL AND ar_amb IS NOT NULL
+          AND in_use = 1
+          {combination_filter}
+    ),
+    labelled AS (
+        SELECT
+            *,
+            CASE azure_cls_calc WHEN 0 THEN 'NEG' WHEN 1 THEN 'POS' WHEN 2 THEN 'EQUIV' END AS azure_label,
+            CASE ar_cls_calc WHEN 0 THEN 'NEG' WHEN 1 THEN 'POS' WHEN 2 THEN 'EQUIV' END AS ar_label
+        FROM effective
+        WHERE azure_cls_calc != ar_cls_calc
+    ),
+    changes AS (
+        SELECT *, lower(azure_label) || '->' || lower(ar_label) AS change_type
+        FROM labelled
+    ),
+    ranked AS (
+        SELECT
+            *,
+            ROW_NUMBER() OVER (PARTITION BY Mix, MixTarget, change_type ORDER BY cfd_diff DESC) AS rn
+        FROM changes
+        WHERE change_type IS NOT NULL {exclude_filter}
+    )
     SELECT
-        original_id,
-        Sample,
-        File,
-        AzureCls,
-        AzureCFD,
-        AzureAmb,
-        ar_cls,
-        ar_cfd,
-        ar_amb,
-        source_table
-    FROM all_readings
-    WHERE Mix = ? AND MixTarget = ?
-      AND AzureCls IS NOT NULL AND AzureAmb IS NOT NULL
-      AND ar_cls IS NOT NULL AND ar_amb IS NOT NULL
-      AND in_use = 1
+        Mix, MixTarget,
+        original_id, Sample, File, azure_cls_calc, AzureCFD, AzureAmb,
+        ar_cls_calc, ar_cfd, ar_amb, source_table,
+        azure_label, ar_label, change_type, cfd_diff,
+        {_READINGS_SELECT}
+    FROM ranked
+    {"WHERE rn <= ?" if limit else ""}
+    ORDER BY Mix, MixTarget, change_type, cfd_diff DESC
     """
 
-    cursor.execute(query, (mix, mixtarget))
+    cursor.execute(query, (*params, *exclude_list, *([limit] if limit else [])))
 
-    # Classification labels
-    cls_labels = {0: 'NEG', 1: 'POS', 2: 'EQUIV'}
+    for (mix, mixtarget), rows in groupby(cursor, key=itemgetter(0, 1)):
+        records = []
+        for row in rows:
+            readings = [r for r in row[-44:] if r is not None]
+            records.append((*row[2:-44], readings))
 
-    records = []
-    for row in cursor.fetchall():
-        orig_id, sample, file, azure_cls, azure_cfd, azure_amb, ar_cls, ar_cfd, ar_amb, source_table = row
+        yield mix, mixtarget, records
 
-        # Calculate effective classifications (amb=1 overrides cls)
-        azure_cls_calc = 2 if azure_amb == 1 else azure_cls
-        ar_cls_calc = 2 if ar_amb == 1 else ar_cls
 
-        # Skip if classifications match
-        if azure_cls_calc == ar_cls_calc:
-            continue
+def produce_groups(db_path, fetch_groups, fetch_kwargs, group_queue):
+    """Run a record fetcher on its own read-only connection and queue each mix-target group"""
+    conn = connect_read_only(db_path)
+    try:
+        for group in fetch_groups(conn, **fetch_kwargs):
+            group_queue.put(group)
+    except Exception as e:
+        group_queue.put(e)
+    finally:
+        conn.close()
+        group_queue.put(_END_OF_GROUPS)
 
-        # Determine change type
-        azure_label = cls_labels[azure_cls_calc]
-        ar_label = cls_labels[ar_cls_calc]
-        change_type = f"{azure_label.lower()}->{ar_label.lower()}"
 
-        # Skip if this change type is excluded
-        if exclude_changes and change_type in exclude_changes:
-            continue
+def get_database_path(conn):
+    """File path of the main database behind a connection"""
+    return conn.execute("PRAGMA database_list").fetchone()[2]
 
-        cfd_diff = abs(azure_cfd - ar_cfd)
 
-        records.append((
-            orig_id, sample, file, azure_cls_calc, azure_cfd, azure_amb,
-            ar_cls_calc, ar_cfd, ar_amb, source_table,
-            azure_label, ar_label, change_type, cfd_diff
-        ))
+def wal_state(wal_path):
+    """Salts and frame count of the current WAL generation, or None without a WAL
 
-    # Sort by change type, then by CFD difference descending
-    records.sort(key=lambda x: (x[12], -x[13]))
+    Read straight from the file, so nothing is written or checkpointed. Each
+    checkpoint reset changes the salts and each commit appends frames carrying
+    them, so the pair changes whenever the WAL contents do.
+    """
+    try:
+        with open(wal_path, 'rb') as wal:
+            header = wal.read(32)
+            if len(header) < 32:
+                return None
+            frame_size = 24 + int.from_bytes(header[8:12], 'big')
+            salts = header[16:24]
+            frame_count = 0
+            while True:
+                wal.seek(32 + frame_count * frame_size)
+                frame_header = wal.read(24)
+                if len(frame_header) < 24 or frame_header[8:16] != salts:
+                    break
+                frame_count += 1
+    except FileNotFoundError:
+        return None
+    return salts, frame_count
+
+
+def database_fingerprint(db_path):
+    """Identify the current database contents for the on-disk record memo
+
+    Opening a WAL database read-only recreates its empty -wal file, so file
+    mtimes alone change on every run. The key is the main file's mtime and size
+    (which change on checkpoints and rollback-journal writes) plus wal_state.
+    """
+    db_stat = os.stat(db_path)
+    return db_stat.st_mtime_ns, db_stat.st_size, wal_state(f"{db_path}-wal")
 
-    # Apply limit if specified - apply limit PER change type
-    if limit:
-        limited_records = []
-        change_type_counts = {}
-        for record in records:
-            change_type = record[12]
-            if change_type not in change_type_counts:
-                change_type_counts[change_type] = 0
 
-            if change_type_counts[change_type] < limit:
-                limited_records.append(record)
-                change_type_counts[change_type] += 1
+def iter_cached_groups(cache_dir, db_path, cache_key, groups):
+    """Replay mix-target groups from an on-disk pickle memo, or record them from groups
+
+    There is one memo file per database and report parameters. It starts with
+    the database_fingerprint it was built from, so any write to the database
+    invalidates it and the next run overwrites it. groups is only iterated on
+    a cache miss.
+    """
+    fingerprint = database_fingerprint(db_path)
+    digest = hashlib.sha1(repr((db_path, cache_key)).encode()).hexdigest()[:16]
+    cache_file = Path(cache_dir).expanduser() / f"az_ar_{digest}.pkl"
+
+    if cache_file.exists():
+        try:
+            with open(cache_file, 'rb') as f:
+                if pickle.load(f) == fingerprint:
+                    print(f"Using cached records: {cache_file}")
+                    cached = pickle.load(f)
+                else:
+                    cached = None
+        except (EOFError, pickle.UnpicklingError):
+            cached = None
+        if cached is not None:
+            yield from cached
+            return
+
+    collected = []
+    for group in groups:
+        collected.append(group)
+        yield group
+
+    # Write to a temp file and rename, so an interrupted dump never leaves a
+    # truncated memo behind
+    cache_file.parent.mkdir(parents=True, exist_ok=True)
+    tmp_file = cache_file.with_name(f"{cache_file.name}.{os.getpid()}.tmp")
+    with open(tmp_file, 'wb') as f:
+        pickle.dump(fingerprint, f, protocol=pickle.HIGHEST_PROTOCOL)
+        pickle.dump(collected, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_file, cache_file)
+
+
+def iter_groups_in_background(conn, fetch_groups, **fetch_kwargs):
+    """Yield fetch_groups results while a producer thread runs the query on a second connection
+
+    SQLite releases the GIL while stepping, so fetching the next mix-target
+    overlaps with rendering and writing the current one.
+    """
+    db_path = get_database_path(conn)
+    group_queue = queue.Queue(maxsize=GROUP_QUEUE_SIZE)
+    producer = threading.Thread(target=produce_groups, args=(db_path, fetch_groups, fetch_kwargs, group_queue),
+                                daemon=True)
+    producer.start()
+    while True:
+        group = group_queue.get()
+        if group is _END_OF_GROUPS:
+            break
+        if isinstance(group, Exception):
+            raise group
+        yield group
+    producer.join()
+
+
+def generate_grid_defs(width=240, height=180, margin=30):
+    """Hidden SVG defining the axis lines shared by every graph of the given size via <use>"""
+    return (
+        f'<svg width="0" height="0" style="position: absolute;"><defs><g id="grid-{width}x{height}">'
+        f'<line x1="{margin}" y1="{margin}" x2="{margin}" y2="{height-margin}" stroke="#ddd" stroke-width="1"/>'
+        f'<line x1="{margin}" y1="{height-margin}" x2="{width-margin}" y2="{height-margin}" stroke="#ddd" stroke-width="1"/>'
+        f'</g></defs></svg>'
+    )
+
 
-        records = limited_records
+@lru_cache(maxsize=None)
+def x_pixels(count, plot_width, margin):
+    """Rounded x pixel positions of count evenly spaced readings
 
-    return records
+    Depends only on the reading count and graph geometry, so every full
+    44-reading curve shares one cached array. Callers must not modify it.
+    """
+    steps = max(count - 1, 1)
+    return np.rint(margin + np.arange(count) * plot_width / steps).astype(np.int64)
 
 
-def generate_svg_graph(record_id, readings, metadata, width=240, height=180):
+def generate_svg_graph(record_id, readings, azure_cls, sample, file, width=240, height=180):
     """
     Generate SVG graph showing the curve.
 
     Args:
         record_id: Record identifier
         readings: Sample readings
-        metadata: Sample metadata dict
+        azure_cls: Effective Azure classification, selects the curve color
+        sample: Sample name for the header
+        file: File name for the header
         width: SVG width
         height: SVG height
     """
@@ -207,8 +382,9 @@ def generate_svg_graph(record_id, readings, metadata, width=240, height=180):
     if not readings or len(readings) < 2:
         return f'<div style="color: red;">No data for ID {record_id}</div>'
 
-    main_min = min(readings)
-    main_max = max(readings)
+    values = np.asarray(readings, dtype=np.float64)
+    main_min = values.min()
+    main_max = values.max()
     value_range = main_max - main_min
 
     if value_range == 0:
@@ -224,54 +400,127 @@ def generate_svg_graph(record_id, readings, metadata, width=240, height=180):
 
     def generate_polyline(readings_data, value_min, value_range):
         """Generate polyline points for a set of readings"""
-        points = []
-        steps = max(len(readings_data) - 1, 1)
-        for i, reading in enumerate(readings_data):
-            x = margin + (i * plot_width / steps)
-            normalized = (reading - value_min) / value_range
-            y = margin + plot_height - (plot_height * normalized)
-            points.append(f"{x:.1f},{y:.1f}")
-        return " ".join(points)
+        ys = margin + plot_height - plot_height * ((readings_data - value_min) / value_range)
+        # Round to whole pixels, then drop interior points that sit on a
+        # horizontal run (same pixel row as both neighbours) - they add no detail
+        xi = x_pixels(len(readings_data), plot_width, margin)
+        yi = np.rint(ys).astype(np.int64)
+        keep = np.ones(len(yi), dtype=bool)
+        keep[1:-1] = (yi[1:-1] != yi[:-2]) | (yi[1:-1] != yi[2:])
+        xi, yi = xi[keep], yi[keep]
+
+        # Format all pairs with one %-substitution
+        coords = np.empty(2 * len(xi), dtype=np.int64)
+        coords[0::2] = xi
+        coords[1::2] = yi
+        return ("%d,%d " * len(xi) % tuple(coords.tolist()))[:-1]
 
     # Generate main sample polyline
-    main_polyline = generate_polyline(readings, min_display, reading_range)
+    main_polyline = generate_polyline(values, min_display, reading_range)
 
     # Determine color based on AzureCls
-    cls_colors = {
-        0: '#2ecc71',  # Green for Negative
-        1: '#e74c3c',  # Red for Positive
-        2: '#f39c12'   # Orange for Ambiguous
-    }
-    main_color = cls_colors.get(metadata['AzureCls'], '#95a5a6')
+    main_color = _CLS_COLORS.get(azure_cls, '#95a5a6')
 
     # Build header text
-    sample_label = str(metadata.get('Sample', 'N/A') or 'N/A')
-    file_label = str(metadata.get('File', 'N/A') or 'N/A')
+    sample_label = str(sample or 'N/A')
+    file_label = str(file or 'N/A')
     header_text = f"{sample_label} | {file_label[:12]}..."
 
-    svg = f'''
-    <div class="graph-container">
-        <div class="graph-header">
-            {header_text}
-        </div>
-        <svg width="{width}" height="{height}" style="background: white;">
-            <!-- Grid lines -->
-            <line x1="{margin}" y1="{margin}" x2="{margin}" y2="{height-margin}" stroke="#ddd" stroke-width="1"/>
-            <line x1="{margin}" y1="{height-margin}" x2="{width-margin}" y2="{height-margin}" stroke="#ddd" stroke-width="1"/>
+    svg = _SVG_TMPL % (
+        header_text, width, height, width, height, main_polyline, main_color,
+        margin - 5, margin + 5, max_display, margin - 5, height - margin + 5, min_display
+    )
+    return svg
 
-            <!-- Main sample curve -->
-            <polyline points="{main_polyline}" fill="none" stroke="{main_color}" stroke-width="2"/>
 
-            <!-- Y-axis labels -->
-            <text x="{margin-5}" y="{margin+5}" text-anchor="end" font-size="10" fill="#666">{max_display:.0f}</text>
-            <text x="{margin-5}" y="{height-margin+5}" text-anchor="end" font-size="10" fill="#666">{min_display:.0f}</text>
-        </svg>
-    </div>
-    '''
-    return svg, metadata
+def build_section(group, show_classification_changes=False, sort_by='azure_cfd'):
+    """Render the HTML section for one (mix, mixtarget, records) group
 
+    Module-level so it can be pickled for ProcessPoolExecutor workers.
+    Returns (mix, mixtarget, html).
+    """
+    mix, mixtarget, records = group
+    parts = []
 
-def generate_comparison_report(conn, output_file, compare_count=None, include_ic=True, show_classification_changes=False, exclude_change_type=None, sort_by='azure_cfd', mixes=None):
+    if show_classification_changes:
+        parts.append(f'<h2>{mix} - {mixtarget}</h2>')
+
+        # Sort records within each change type group based on sort_by parameter
+        # (ar_cfd is at index 7 in the record tuple, azure_cfd at index 4)
+        sort_key = itemgetter(7) if sort_by == 'ar_cfd' else itemgetter(4)
+
+        # Records arrive ordered by change type, so each run is one section
+        for change_type, change_records in groupby(records, key=itemgetter(12)):
+            change_records = sorted(change_records, key=sort_key, reverse=True)
+
+            parts.append(f'<h3>Classification Change: {change_type.upper()}</h3>')
+            parts.append(f'''
+            <div class="stats">
+                {len(change_records)} samples with {change_type} change, sorted by CFD difference
+            </div>
+            ''')
+
+            for orig_id, sample, file, azure_cls, azure_cfd, azure_amb, ar_cls, ar_cfd, ar_amb, source_table, azure_label, ar_label, change_type_str, cfd_diff, readings in change_records:
+                # Explicit guards instead of a per-record try/except: curves need
+                # two points and both CFDs are printed
+                if len(readings) < 2:
+                    continue
+                if azure_cfd is None or ar_cfd is None:
+                    print(f"    Skipping record {orig_id}: missing CFD")
+                    continue
+
+                svg_graph = generate_svg_graph(orig_id, readings, azure_cls, sample, file)
+
+                result_html = f'''
+                <div class="result-box">
+                    <div class="label">AZURE vs AR</div>
+                    <div class="azure">
+                        Azure: {azure_label}<br/>CFD: {azure_cfd:.2f}
+                    </div>
+                    <div class="ar">
+                        AR: {ar_label}<br/>CFD: {ar_cfd:.2f}
+                    </div>
+                    <div class="cfd-diff">Δ CFD: {cfd_diff:.2f}</div>
+                </div>
+                '''
+
+                parts.append(svg_graph.rstrip() + '\n' + result_html)
+
+    else:
+        # Original ranking-based mode
+        parts.append(f'''
+            <h2>{mix} - {mixtarget}</h2>
+            <div class="stats">
+                Showing top {len(records)} samples with largest ranking disagreements
+            </div>
+        ''')
+
+        for orig_id, sample, file, azure_cls, azure_cfd, azure_order, ar_cls, ar_cfd, ar_order, source_table, azure_cls_label, ar_cls_label, rank_diff, readings in records:
+            # Curves need two points; the query already requires both CFDs
+            if len(readings) < 2:
+                continue
+
+            svg_graph = generate_svg_graph(orig_id, readings, azure_cls, sample, file)
+
+            result_html = f'''
+            <div class="result-box">
+                <div class="label">AZURE vs AR</div>
+                <div class="azure">
+                    Azure: {azure_cls_label}<br/>CFD: {azure_cfd:.2f}<br/>Rank: {azure_order}
+                </div>
+                <div class="ar">
+                    AR: {ar_cls_label}<br/>CFD: {ar_cfd:.2f}<br/>Rank: {ar_order}
+                </div>
+                <div class="rank-diff">Δ Rank: {rank_diff}</div>
+            </div>
+            '''
+
+            parts.append(svg_graph.rstrip() + '\n' + result_html)
+
+    return mix, mixtarget, ''.join(parts)
+
+
+def generate_comparison_report(conn, output_file, compare_count=None, include_ic=True, show_classification_changes=False, exclude_change_type=None, sort_by='azure_cfd', mixes=None, cache_dir=None, workers=1):
     """
     Generate comparison report of Azure vs AR results.
 
@@ -284,32 +533,10 @@ def generate_comparison_report(conn, output_file, compare_count=None, include_ic
         exclude_change_type: List of change types to exclude (e.g., ['pos->neg'])
         sort_by: Sort records within groups by 'azure_cfd' or 'ar_cfd' (default: 'azure_cfd')
         mixes: Set of mix names to include (default: None = all mixes)
+        cache_dir: Directory for the on-disk record memo (default: None = no caching)
+        workers: Number of processes rendering sections (default: 1 = no multiprocessing)
     """
 
-    # Get mix-target combinations (exclude IC if specified, filter by mixes if specified)
-    cursor = conn.cursor()
-    ic_filter = "" if include_ic else "AND MixTarget != 'IC'"
-
-    # Build mixes filter
-    if mixes:
-        placeholders = ','.join('?' * len(mixes))
-        mix_filter = f"AND Mix IN ({placeholders})"
-        query_params = list(mixes)
-    else:
-        mix_filter = ""
-        query_params = []
-
-    cursor.execute(f"""
-        SELECT DISTINCT Mix, MixTarget
-        FROM all_readings
-        WHERE AzureCFD IS NOT NULL AND ar_cfd IS NOT NULL
-              {ic_filter}
-              {mix_filter}
-        ORDER BY Mix, MixTarget
-    """, query_params)
-
-    combinations = cursor.fetchall()
-
     # Determine report title and header text based on mode
     if show_classification_changes:
         report_title = "Azure vs AR Classification Changes Report"
@@ -326,270 +553,180 @@ def generate_comparison_report(conn, output_file, compare_count=None, include_ic
         </div>
         """
 
-    html_content = f'''
-    <!DOCTYPE html>
-    <html>
-    <head>
-        <title>{report_title}</title>
-        <style>
-            body {{
-                font-family: Arial, sans-serif;
-                margin: 10px;
-                background-color: #f5f5f5;
-            }}
-            .header {{
-                text-align: center;
-                margin: 20px 0;
-            }}
-            h1 {{
-                text-align: center;
-                margin: 30px 0 20px 0;
-                padding: 20px;
-                background: #2c3e50;
-                color: white;
-                border-radius: 8px;
-                font-size: 1.8em;
-            }}
-            h2 {{
-                text-align: center;
-                margin: 30px 0 15px 0;
-                padding: 15px;
-                background: #34495e;
-                color: white;
-                border-radius: 8px;
-                font-size: 1.4em;
-            }}
-            h3 {{
-                text-align: left;
-                margin: 20px 0 10px 0;
-                padding: 10px;
-                background: #5d6d7b;
-                color: white;
-                border-radius: 4px;
-                font-size: 1.1em;
-            }}
-            .container {{
-                display: grid;
-                grid-template-columns: repeat(5, 1fr);
-                gap: 8px;
-                max-width: 1400px;
-                margin: 0 auto;
-            }}
-            .graph-container {{
-                background: white;
-                border: 1px solid #ddd;
-                border-radius: 4px;
-                padding: 4px;
-                text-align: center;
-            }}
-            .graph-header {{
-                font-size: 10px;
-                margin-bottom: 4px;
-                color: #333;
-                font-weight: bold;
-            }}
-            .result-box {{
-                font-size: 8px;
-                margin-top: 6px;
-                padding: 6px;
-                background: #ecf0f1;
-                border: 1px solid #bdc3c7;
-                border-radius: 3px;
-                text-align: center;
-                line-height: 1.4;
-            }}
-            .result-box .label {{
-                font-weight: bold;
-                color: #2c3e50;
-                margin-bottom: 4px;
-                border-bottom: 1px solid #bdc3c7;
-                padding-bottom: 3px;
-            }}
-            .result-box .azure {{
-                color: #3498db;
-                font-weight: bold;
-                margin-top: 3px;
-            }}
-            .result-box .ar {{
-                color: #e67e22;
-                font-weight: bold;
-                margin-top: 3px;
-            }}
-            .rank-diff {{
-                font-size: 7px;
-                color: #c0392b;
-                font-weight: bold;
-                margin-top: 4px;
-                padding-top: 3px;
-                border-top: 1px solid #bdc3c7;
-            }}
-            .cfd-diff {{
-                font-size: 7px;
-                color: #2980b9;
-                font-weight: bold;
-                margin-top: 4px;
-                padding-top: 3px;
-                border-top: 1px solid #bdc3c7;
-            }}
-            .stats {{
-                grid-column: 1 / -1;
-                text-align: center;
-                margin: 10px 0;
-                padding: 10px;
-                background: #ecf0f1;
-                border-radius: 4px;
-                color: #2c3e50;
-            }}
-            .warning {{
-                color: #c0392b;
-                font-size: 0.9em;
-            }}
-        </style>
-    </head>
-    <body>
-        <div class="header">
-            <h1>{report_title}</h1>
-            <p style="color: #666;">{report_subtitle}</p>
-            {header_note}
-        </div>
-        <div class="container">
-    '''
-
-    print(f"Generating {report_title} for {len(combinations)} mix-target combinations...")
-
-    for mix, mixtarget in combinations:
-        print(f"  Processing {mix}-{mixtarget}...")
-
+    # Stream the report to disk fragment by fragment instead of growing one large string
+    with open(output_file, 'w', buffering=1 << 20) as f:
+        f.write(f'''
+        <!DOCTYPE html>
+        <html>
+        <head>
+            <title>{report_title}</title>
+            <style>
+                body {{
+                    font-family: Arial, sans-serif;
+                    margin: 10px;
+                    background-color: #f5f5f5;
+                }}
+                .header {{
+                    text-align: center;
+                    margin: 20px 0;
+                }}
+                h1 {{
+                    text-align: center;
+                    margin: 30px 0 20px 0;
+                    padding: 20px;
+                    background: #2c3e50;
+                    color: white;
+                    border-radius: 8px;
+                    font-size: 1.8em;
+                }}
+                h2 {{
+                    text-align: center;
+                    margin: 30px 0 15px 0;
+                    padding: 15px;
+                    background: #34495e;
+                    color: white;
+                    border-radius: 8px;
+                    font-size: 1.4em;
+                }}
+                h3 {{
+                    text-align: left;
+                    margin: 20px 0 10px 0;
+                    padding: 10px;
+                    background: #5d6d7b;
+                    color: white;
+                    border-radius: 4px;
+                    font-size: 1.1em;
+                }}
+                .container {{
+                    display: grid;
+                    grid-template-columns: repeat(5, 1fr);
+                    gap: 8px;
+                    max-width: 1400px;
+                    margin: 0 auto;
+                }}
+                .graph-container {{
+                    background: white;
+                    border: 1px solid #ddd;
+                    border-radius: 4px;
+                    padding: 4px;
+                    text-align: center;
+                }}
+                .graph-header {{
+                    font-size: 10px;
+                    margin-bottom: 4px;
+                    color: #333;
+                    font-weight: bold;
+                }}
+                .result-box {{
+                    font-size: 8px;
+                    margin-top: 6px;
+                    padding: 6px;
+                    background: #ecf0f1;
+                    border: 1px solid #bdc3c7;
+                    border-radius: 3px;
+                    text-align: center;
+                    line-height: 1.4;
+                }}
+                .result-box .label {{
+                    font-weight: bold;
+                    color: #2c3e50;
+                    margin-bottom: 4px;
+                    border-bottom: 1px solid #bdc3c7;
+                    padding-bottom: 3px;
+                }}
+                .result-box .azure {{
+                    color: #3498db;
+                    font-weight: bold;
+                    margin-top: 3px;
+                }}
+                .result-box .ar {{
+                    color: #e67e22;
+                    font-weight: bold;
+                    margin-top: 3px;
+                }}
+                .rank-diff {{
+                    font-size: 7px;
+                    color: #c0392b;
+                    font-weight: bold;
+                    margin-top: 4px;
+                    padding-top: 3px;
+                    border-top: 1px solid #bdc3c7;
+                }}
+                .cfd-diff {{
+                    font-size: 7px;
+                    color: #2980b9;
+                    font-weight: bold;
+                    margin-top: 4px;
+                    padding-top: 3px;
+                    border-top: 1px solid #bdc3c7;
+                }}
+                .stats {{
+                    grid-column: 1 / -1;
+                    text-align: center;
+                    margin: 10px 0;
+                    padding: 10px;
+                    background: #ecf0f1;
+                    border-radius: 4px;
+                    color: #2c3e50;
+                }}
+                .warning {{
+                    color: #c0392b;
+                    font-size: 0.9em;
+                }}
+            </style>
+        </head>
+        <body>
+            {generate_grid_defs()}
+            <div class="header">
+                <h1>{report_title}</h1>
+                <p style="color: #666;">{report_subtitle}</p>
+                {header_note}
+            </div>
+            <div class="container">
+        ''')
+
+        print(f"Generating {report_title}...")
+
+        # One grouped query yields the records of every mix-target combination
+        # (exclude IC if specified, filter by mixes if specified); it runs on a
+        # background thread so fetching overlaps with rendering
         if show_classification_changes:
-            # Get classification change records
-            records = get_classification_change_records(conn, mix, mixtarget, exclude_changes=exclude_change_type, limit=compare_count)
-            if not records:
-                continue
-
-            html_content += f'<h2>{mix} - {mixtarget}</h2>'
-
-            # Group by change type
-            changes_dict = {}
-            for record in records:
-                change_type = record[12]
-                if change_type not in changes_dict:
-                    changes_dict[change_type] = []
-                changes_dict[change_type].append(record)
-
-            # Display each change type as a section
-            for change_type in sorted(changes_dict.keys()):
-                change_records = changes_dict[change_type]
-
-                # Sort records within this change type group based on sort_by parameter
-                if sort_by == 'ar_cfd':
-                    # ar_cfd is at index 7 in the record tuple
-                    change_records = sorted(change_records, key=lambda x: x[7], reverse=True)
-                else:  # default: azure_cfd
-                    # azure_cfd is at index 4 in the record tuple
-                    change_records = sorted(change_records, key=lambda x: x[4], reverse=True)
-
-                html_content += f'<h3>Classification Change: {change_type.upper()}</h3>'
-                html_content += f'''
-                <div class="stats">
-                    {len(change_records)} samples with {change_type} change, sorted by CFD difference
-                </div>
-                '''
-
-                for orig_id, sample, file, azure_cls, azure_cfd, azure_amb, ar_cls, ar_cfd, ar_amb, source_table, azure_label, ar_label, change_type_str, cfd_diff in change_records:
-                    try:
-                        readings = get_readings_for_id(conn, orig_id, source_table)
-                        if not readings:
-                            continue
-
-                        metadata = {
-                            'AzureCls': azure_cls,
-                            'AzureCFD': azure_cfd,
-                            'Sample': sample,
-                            'File': file
-                        }
-
-                        svg_graph, _ = generate_svg_graph(orig_id, readings, metadata)
-
-                        result_html = f'''
-                        <div class="result-box">
-                            <div class="label">AZURE vs AR</div>
-                            <div class="azure">
-                                Azure: {azure_label}<br/>CFD: {azure_cfd:.2f}
-                            </div>
-                            <div class="ar">
-                                AR: {ar_label}<br/>CFD: {ar_cfd:.2f}
-                            </div>
-                            <div class="cfd-diff">Δ CFD: {cfd_diff:.2f}</div>
-                        </div>
-                        '''
-
-                        combined = svg_graph.rstrip() + '\n' + result_html
-                        html_content += combined
-
-                    except Exception as e:
-                        print(f"    Error processing record {orig_id}: {e}")
-                        continue
-
+            groups = iter_groups_in_background(conn, get_classification_change_records,
+                                               exclude_changes=exclude_change_type, limit=compare_count,
+                                               include_ic=include_ic, mixes=mixes)
         else:
-            # Original ranking-based mode
-            records = get_azure_records_with_ar(conn, mix, mixtarget, limit=compare_count)
-            if not records:
-                continue
-
-            html_content += f'''
-                <h2>{mix} - {mixtarget}</h2>
-                <div class="stats">
-                    Showing top {len(records)} samples with largest ranking disagreements
-                </div>
-            '''
-
-            for orig_id, sample, file, azure_cls, azure_cfd, azure_order, ar_cls, ar_cfd, ar_order, source_table, azure_cls_label, ar_cls_label in records:
-                try:
-                    readings = get_readings_for_id(conn, orig_id, source_table)
-                    if not readings:
-                        continue
-
-                    rank_diff = abs(azure_order - ar_order)
-
-                    metadata = {
-                        'AzureCls': azure_cls,
-                        'AzureCFD': azure_cfd,
-                        'Sample': sample,
-                        'File': file
-                    }
-
-                    svg_graph, _ = generate_svg_graph(orig_id, readings, metadata)
-
-                    result_html = f'''
-                    <div class="result-box">
-                        <div class="label">AZURE vs AR</div>
-                        <div class="azure">
-                            Azure: {azure_cls_label}<br/>CFD: {azure_cfd:.2f}<br/>Rank: {azure_order}
-                        </div>
-                        <div class="ar">
-                            AR: {ar_cls_label}<br/>CFD: {ar_cfd:.2f}<br/>Rank: {ar_order}
-                        </div>
-                        <div class="rank-diff">Δ Rank: {rank_diff}</div>
-                    </div>
-                    '''
-
-                    combined = svg_graph.rstrip() + '\n' + result_html
-                    html_content += combined
-
-                except Exception as e:
-                    print(f"    Error processing record {orig_id}: {e}")
-                    continue
-
-    html_content += '''
-        </div>
-    </body>
-    </html>
-    '''
-
-    # Write file
-    with open(output_file, 'w') as f:
-        f.write(html_content)
-
+            groups = iter_groups_in_background(conn, get_azure_records_with_ar,
+                                               limit=compare_count, include_ic=include_ic, mixes=mixes)
+
+        if cache_dir:
+            cache_key = (show_classification_changes, compare_count, include_ic,
+                         sorted(mixes) if mixes else None,
+                         sorted(exclude_change_type) if exclude_change_type else None)
+            groups = iter_cached_groups(cache_dir, get_database_path(conn), cache_key, groups)
+
+        # Sections are rendered in order, optionally across worker processes; at
+        # most two groups per worker are in flight so the bounded producer queue
+        # keeps streaming instead of being drained up front
+        render = partial(build_section, show_classification_changes=show_classification_changes, sort_by=sort_by)
+        executor = ProcessPoolExecutor(max_workers=workers) if workers > 1 else None
+        sections = bounded_map(executor, render, groups, window=2 * workers) if executor else map(render, groups)
+
+        combination_count = 0
+        for mix, mixtarget, section_html in sections:
+            combination_count += 1
+            print(f"  Processing {mix}-{mixtarget}...")
+            f.write(section_html)
+
+        if executor:
+            executor.shutdown()
+
+        f.write('''
+            </div>
+        </body>
+        </html>
+        ''')
+
+    print(f"Processed {combination_count} mix-target combinations")
     print(f"\nHTML report generated: {output_file}")
 
 
@@ -614,6 +751,10 @@ def main():
                        help='Sort records within groups by: azure_cfd (Azure CFD), ar_cfd (AR CFD) (default: azure_cfd)')
     parser.add_argument('--mixes',
                        help='Comma-separated list of mix names to include (default: all mixes)')
+    parser.add_argument('--cache-dir',
+                       help='Directory for an on-disk memo of fetched records, reused until the database changes (default: disabled)')
+    parser.add_argument('--workers', type=int, default=1,
+                       help='Number of worker processes rendering mix-target sections (default: 1 = no multiprocessing)')
 
     args = parser.parse_args()
 
@@ -624,9 +765,26 @@ def main():
         print(f"Error: Database file not found: {db_path}")
         sys.exit(1)
 
-    # Connect to database
+    # Build the report indexes on a short-lived read/write connection
     conn = sqlite3.connect(str(db_path))
 
+    # Every per-combination query filters on Mix, MixTarget and in_use
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_all_readings_mix_target ON all_readings(Mix, MixTarget, in_use)")
+    # Partial index over rows with complete Azure/AR rankings, ordered the way the
+    # ranking query's ROW_NUMBER() window sorts them, so no window sort is needed
+    conn.execute("""
+        CREATE INDEX IF NOT EXISTS idx_all_readings_rank_diff
+        ON all_readings(Mix, MixTarget, ABS(azure_order - ar_order) DESC)
+        WHERE in_use = 1 AND AzureCFD IS NOT NULL AND ar_cfd IS NOT NULL
+          AND azure_order IS NOT NULL AND ar_order IS NOT NULL
+    """)
+    conn.commit()
+    conn.execute("PRAGMA optimize")
+    conn.close()
+
+    # The report itself only reads
+    conn = connect_read_only(db_path)
+
     include_ic = not args.no_ic
     exclude_changes = set(args.exclude_change_type) if args.exclude_change_type else None
 
@@ -646,7 +804,9 @@ def main():
         show_classification_changes=args.show_classification_changes,
         exclude_change_type=exclude_changes,
         sort_by=args.sort_by,
-        mixes=mixes
+        mixes=mixes,
+        cache_dir=args.cache_dir,
+        workers=args.workers
     )
 
     conn.close()
@@ -2,122 +2,95 @@
 
 import sqlite3
 import numpy as np
-import random
 import argparse
 from tqdm import tqdm
 import os
-import struct
-from scipy import stats
-
-def bytes_to_float(value):
-    """Convert bytes to float if needed, otherwise return as-is"""
-    if isinstance(value, bytes):
-        return struct.unpack('d', value)[0]
-    return value
-
-def compute_negative_cusum(y_vals, k=0.0):
-    """Compute negative CUSUM with adjustable k parameter - matches original algorithm"""
-    cusum = [0]
-    for i in range(1, len(y_vals)):
-        diff = y_vals[i] - y_vals[i - 1]
-        s = min(0, cusum[-1] + (diff - k))
-        cusum.append(s)
-    return cusum
-
-def smooth_curve(y_vals, window_size=5):
-    """Apply smoothing to curve data"""
-    if len(y_vals) < window_size:
-        return y_vals
-    
-    smoothed = []
-    half_window = window_size // 2
-    
-    for i in range(len(y_vals)):
-        start = max(0, i - half_window)
-        end = min(len(y_vals), i + half_window + 1)
-        smoothed.append(sum(y_vals[start:end]) / (end - start))
-    
-    return smoothed
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+
+# Import from utils
+try:
+    from utils.algorithms import cusum_pipeline_batch, lob_gradient_numerator, find_cusum_minimum_index, \
+        population_std
+    from utils.database import connect_read_only, iter_readings_for_ids, bytes_to_float, bytes_to_floats
+    from utils.parallel import bounded_map
+except ModuleNotFoundError:
+    from flatten.utils.algorithms import cusum_pipeline_batch, lob_gradient_numerator, find_cusum_minimum_index, \
+        population_std
+    from flatten.utils.database import connect_read_only, iter_readings_for_ids, bytes_to_float, bytes_to_floats
+    from flatten.utils.parallel import bounded_map
+
+# Records whose readings are fetched and run through the CUSUM together
+CUSUM_BATCH_SIZE = 4096
+
+# Random source for the flattening noise
+_rng = np.random.default_rng()
+
+# Column lists for the combined readings + stored CUSUM fetch
+_READINGS_COLUMNS = ", ".join(f"readings{i}" for i in range(44))
+_CUSUM_COLUMNS = ", ".join(f"cusum{i}" for i in range(44))
 
 def compute_derivative(readings):
     """Compute derivative (rate of change) between consecutive readings"""
-    if len(readings) < 2:
-        return []
-    
-    derivatives = []
-    for i in range(1, len(readings)):
-        derivative = readings[i] - readings[i-1]
-        derivatives.append(derivative)
-    
-    return derivatives
+    return np.diff(np.asarray(readings, dtype=np.float64))
 
 def find_derivative_minimum(readings):
     """Find the minimum derivative value and its index"""
     derivatives = compute_derivative(readings)
-    if not derivatives:
+    if derivatives.size == 0:
         return 0, 0
     
-    min_derivative = min(derivatives)
+    min_position = int(derivatives.argmin())
     # Add 1 to index because derivative array is 1 element shorter
-    min_index = derivatives.index(min_derivative) + 1
-    
-    return min_derivative, min_index
+    return float(derivatives[min_position]), min_position + 1
 
-def apply_corrected_cusum_algorithm(readings, k=0.0):
-    """Apply the corrected CUSUM algorithm with adjustable k parameter"""
-    margin = 50
-    plot_width = 800 - 2 * margin
-    plot_height = 400 - 2 * margin
-    
-    min_reading = min(readings)
-    max_reading = max(readings)
-    reading_range = max_reading - min_reading if max_reading != min_reading else 1
-    
-    # Convert to SVG coordinates (same as original algorithm)
-    svg_y_vals = []
-    for reading in readings:
-        svg_y = margin + plot_height - (plot_height * (reading - min_reading) / reading_range)
-        svg_y_vals.append(svg_y)
-    
-    svg_y_vals = np.array(svg_y_vals)
-    
-    # Apply simple inversion
-    y_inv = np.max(svg_y_vals) - svg_y_vals
-    
-    # Smooth the inverted data
-    y_smooth = smooth_curve(y_inv)
+def batch_cusum(readings_list, k):
+    """Compute (cusum, cusum_min, min_index) for each record's readings
+
+    Records of equal length are stacked and run through one 2-D
+    cusum_pipeline_batch call, so the per-record cost is a row view.
+    """
+    results = [None] * len(readings_list)
+    positions_by_length = {}
+    for position, readings in enumerate(readings_list):
+        positions_by_length.setdefault(len(readings), []).append(position)
     
-    # Apply CUSUM with custom k parameter
-    cusum = compute_negative_cusum(y_smooth, k=k)
+    for positions in positions_by_length.values():
+        cusum, cusum_min, cusum_argmin = cusum_pipeline_batch([readings_list[p] for p in positions], k=k)
+        for row, position in enumerate(positions):
+            results[position] = (cusum[row], float(cusum_min[row]), int(cusum_argmin[row]))
     
-    return cusum, min(cusum)
+    return results
+
+def iter_readings_and_cusum_for_ids(conn, ids, batch_size=900):
+    """Yield (id, readings, cusum_cells) for IDs in order, one SELECT per batch of IDs
 
-def get_readings_for_id(conn, target_id):
-    """Get readings for a specific ID"""
+    readings drops NULLs as in iter_readings_for_ids; cusum_cells is the raw
+    cusum0-cusum43 tuple from the same row (empty for a missing ID).
+    """
     cursor = conn.cursor()
-    readings_columns = [f"readings{i}" for i in range(44)]
-    readings_select = ", ".join(readings_columns)
-    cursor.execute(f"SELECT {readings_select} FROM all_readings WHERE id = ?", (target_id,))
-    row = cursor.fetchone()
-    if not row:
-        return []
-    readings = [r for r in row if r is not None]
-    return readings
-
-def find_cusum_minimum_index(cusum_values):
-    """Find the index where CUSUM reaches its minimum value"""
-    min_val = min(cusum_values)
-    return cusum_values.index(min_val)
-
-def create_flattened_readings(original_readings, cusum_values, cusum_min, threshold=-80, sanity_check=False, sanity_lob=False):
+    for start in range(0, len(ids), batch_size):
+        batch = ids[start:start + batch_size]
+        placeholders = ','.join(['?'] * len(batch))
+        cursor.execute(f"SELECT id, {_READINGS_COLUMNS}, {_CUSUM_COLUMNS} FROM all_readings "
+                       f"WHERE id IN ({placeholders})", batch)
+        rows = {row[0]: row[1:] for row in cursor.fetchall()}
+        for target_id in batch:
+            row = rows.get(target_id, ())
+            yield target_id, [r for r in row[:44] if r is not None], row[44:]
+
+def create_flattened_readings(original_readings, cusum_values, cusum_min, threshold=-80, sanity_check=False, sanity_lob=False,
+                              min_index=None):
     """Create flattened readings for curves with significant downward trends"""
     
     # Only flatten if CUSUM min <= threshold
     if cusum_min > threshold:
         return None
     
-    # Find the index where CUSUM reaches minimum (end of downward slope)
-    min_index = find_cusum_minimum_index(cusum_values)
+    # Find the index where CUSUM reaches minimum (end of downward slope),
+    # unless the caller already has it from the CUSUM computation
+    if min_index is None:
+        min_index = find_cusum_minimum_index(cusum_values)
     
     # Skip if minimum occurs too early (nothing to flatten)
     if min_index <= 1:
@@ -131,10 +104,10 @@ def create_flattened_readings(original_readings, cusum_values, cusum_min, thresh
         # Check if min_index is in first five cycles
         if min_index < 5:
             # For first five cycles, compare with average of first two
-            avg_first = np.mean(original_readings[:2])
+            avg_first = sum(original_readings[:2]) / 2
         else:
             # Otherwise, compare with average of first five cycles
-            avg_first = np.mean(original_readings[:5])
+            avg_first = sum(original_readings[:5]) / 5
         
         # Skip if the reading at cusum min is not lower than the early average
         if target_reading >= avg_first:
@@ -142,34 +115,38 @@ def create_flattened_readings(original_readings, cusum_values, cusum_min, thresh
     
     if sanity_lob:
         # Line of Best Fit sanity check: check gradient from first to CUSUM min
-        # Use readings from index 0 to min_index (inclusive)
-        x_values = np.arange(min_index + 1)
-        y_values = original_readings[:min_index + 1]
-        
-        # Calculate line of best fit using scipy.stats.linregress
-        slope, intercept, r_value, p_value, std_err = stats.linregress(x_values, y_values)
+        # Use readings from index 0 to min_index (inclusive). Only the sign of the
+        # gradient is needed, so the closed-form numerator replaces linregress
+        slope_sign = lob_gradient_numerator(original_readings[:min_index + 1])
         
         # Check if gradient is negative (downward trend)
-        if slope >= 0:
+        if slope_sign >= 0:
             return None  # LOB sanity check failed, don't flatten
     
     # Determine appropriate noise scale based on data
-    reading_std = np.std(original_readings)
+    reading_std = population_std(original_readings)
     noise_scale = reading_std * 0.001  # Very small noise, 0.1% of standard deviation
     
     # Create flattened readings
-    flattened = original_readings.copy()
+    flattened = np.array(original_readings, dtype=np.float64)
     
-    # Flatten all readings before the minimum point
-    for i in range(min_index):
-        # Add small random noise to prevent identical values
-        noise = random.uniform(-noise_scale, noise_scale)
-        flattened[i] = target_reading + noise
+    # Flatten all readings before the minimum point, adding small random noise
+    # (drawn in one call) to prevent identical values
+    flattened[:min_index] = target_reading + _rng.uniform(-noise_scale, noise_scale, size=min_index)
     
     return flattened, min_index
 
+def build_svg_path(x_values, y_values):
+    """Build an SVG path string "M x y L x y ..." with a single %-format call"""
+    if len(y_values) == 0:
+        return ""
+    coords = np.empty(2 * len(y_values))
+    coords[0::2] = x_values
+    coords[1::2] = y_values
+    return ("M %.1f %.1f" + " L %.1f %.1f" * (len(y_values) - 1)) % tuple(coords.tolist())
+
 def generate_svg_comparison_graph(record_id, readings, default_values, test_values,
-                                 default_min, test_min, args, threshold, 
+                                 default_min, test_min, default_min_index, test_min_index, args, threshold, 
                                  width=320, height=240):
     """Generate SVG graph comparing two methods (CUSUM or derivative) with full visualization"""
     
@@ -193,23 +170,24 @@ def generate_svg_comparison_graph(record_id, readings, default_values, test_valu
     if test_flattened and not args.use_test_derivative:
         # Only create flattened readings for CUSUM-based test (not derivative)
         flattening_result = create_flattened_readings(readings, test_values, test_min, threshold, 
+                                                      min_index=test_min_index,
                                                       sanity_check=args.sanity_check_slope,
                                                       sanity_lob=args.sanity_lob)
     
-    # Scale calculations for readings
-    all_values = readings.copy()
+    # Scale calculations for readings (NumPy reductions rather than Python min/max over lists)
+    all_values = np.asarray(readings, dtype=np.float64)
     if flattening_result:
         flattened_readings, min_index = flattening_result
-        all_values.extend(flattened_readings)
+        all_values = np.concatenate((all_values, flattened_readings))
     
-    readings_min = min(all_values)
-    readings_max = max(all_values)
+    readings_min = all_values.min()
+    readings_max = all_values.max()
     readings_range = readings_max - readings_min if readings_max != readings_min else 1
     
     # Scale calculations for analysis values (CUSUM or derivative)
-    all_analysis_values = list(default_values) + list(test_values)
-    analysis_min_val = min(all_analysis_values)
-    analysis_max_val = max(all_analysis_values)
+    all_analysis_values = np.concatenate((default_values, test_values))
+    analysis_min_val = all_analysis_values.min()
+    analysis_max_val = all_analysis_values.max()
     analysis_range = analysis_max_val - analysis_min_val if analysis_max_val != analysis_min_val else 1
     
     max_index_plot = len(readings) - 1
@@ -223,39 +201,21 @@ def generate_svg_comparison_graph(record_id, readings, default_values, test_valu
     def y_scale_analysis(value):
         return margin + plot_height - ((value - analysis_min_val) / analysis_range) * plot_height
     
-    # Generate readings path
-    readings_path = []
-    for i, reading in enumerate(readings):
-        x = x_scale(i)
-        y_read = y_scale_readings(reading)
-        readings_path.append(f"{'M' if i == 0 else 'L'} {x:.1f} {y_read:.1f}")
-    
-    readings_path_str = " ".join(readings_path)
+    # Generate readings path (coordinates computed as arrays, see build_svg_path)
+    x_values = x_scale(np.arange(len(readings)))
+    readings_path_str = build_svg_path(x_values, y_scale_readings(np.asarray(readings, dtype=np.float64)))
     
     # Generate analysis paths (CUSUM or derivative)
-    default_analysis_path = []
-    test_analysis_path = []
-    for i, (default_val, test_val) in enumerate(zip(default_values, test_values)):
-        x = x_scale(i)
-        y_default = y_scale_analysis(default_val)
-        y_test = y_scale_analysis(test_val)
-        
-        default_analysis_path.append(f"{'M' if i == 0 else 'L'} {x:.1f} {y_default:.1f}")
-        test_analysis_path.append(f"{'M' if i == 0 else 'L'} {x:.1f} {y_test:.1f}")
-    
-    default_analysis_path_str = " ".join(default_analysis_path)
-    test_analysis_path_str = " ".join(test_analysis_path)
+    num_analysis = min(len(default_values), len(test_values))
+    analysis_x_values = x_values[:num_analysis] if max_index_plot > 0 else x_values
+    default_analysis_path_str = build_svg_path(analysis_x_values, y_scale_analysis(default_values[:num_analysis]))
+    test_analysis_path_str = build_svg_path(analysis_x_values, y_scale_analysis(test_values[:num_analysis]))
     
     # Generate flattened path if applicable
     flattened_path_str = ""
     if flattening_result:
         flattened_readings, min_idx = flattening_result
-        flattened_path = []
-        for i, flat_reading in enumerate(flattened_readings):
-            x = x_scale(i)
-            y_flat = y_scale_readings(flat_reading)
-            flattened_path.append(f"{'M' if i == 0 else 'L'} {x:.1f} {y_flat:.1f}")
-        flattened_path_str = " ".join(flattened_path)
+        flattened_path_str = build_svg_path(x_values, y_scale_readings(np.asarray(flattened_readings, dtype=np.float64)))
     
     # Determine status and color
     if default_flattened != test_flattened:
@@ -322,18 +282,16 @@ def generate_svg_comparison_graph(record_id, readings, default_values, test_valu
     
     # Add analysis minimum markers
     # Default method minimum marker
-    default_min_idx = default_values.index(default_min) if default_min in default_values else 0
-    default_marker_x = x_scale(default_min_idx)
-    default_marker_y = y_scale_readings(readings[default_min_idx])
+    default_marker_x = x_scale(default_min_index)
+    default_marker_y = y_scale_readings(readings[default_min_index])
     
     svg += f'''
             <!-- Default method minimum marker -->
             <circle cx="{default_marker_x}" cy="{default_marker_y}" r="2" fill="red" opacity="0.8"/>'''
     
     # Test method minimum marker
-    test_min_idx = test_values.index(test_min) if test_min in test_values else 0
-    test_marker_x = x_scale(test_min_idx)
-    test_marker_y = y_scale_readings(readings[test_min_idx])
+    test_marker_x = x_scale(test_min_index)
+    test_marker_y = y_scale_readings(readings[test_min_index])
     
     svg += f'''
             <!-- Test method minimum marker -->
@@ -354,8 +312,15 @@ def generate_svg_comparison_graph(record_id, readings, default_values, test_valu
     
     return svg
 
-def get_all_records(conn, mixes_filter=None):
-    """Get all records for comparison"""
+def record_order_sql(sort_by='cusum', sort_order='up', prefix=''):
+    """ORDER BY clause for the record selection queries, ties broken by ascending id"""
+    direction = 'DESC' if sort_order == 'down' else 'ASC'
+    if sort_by == 'id':
+        return f" ORDER BY {prefix}id {direction}"
+    return f" ORDER BY {prefix}cusum_min_correct {direction}, {prefix}id ASC"
+
+def get_all_records(conn, mixes_filter=None, sort_by='cusum', sort_order='up', limit=None):
+    """Get all records for comparison, sorted and limited by SQLite"""
     cursor = conn.cursor()
 
     query = """
@@ -370,13 +335,16 @@ def get_all_records(conn, mixes_filter=None):
         query += f" AND Mix IN ({placeholders})"
         params.extend(mixes_filter)
 
-    query += " ORDER BY cusum_min_correct ASC"
+    query += record_order_sql(sort_by, sort_order)
+    if limit:
+        query += " LIMIT ?"
+        params.append(limit)
 
     cursor.execute(query, params)
     return cursor.fetchall()
 
-def get_example_ids(conn, mixes_filter=None):
-    """Get example IDs from database"""
+def get_example_ids(conn, mixes_filter=None, sort_by='cusum', sort_order='up', limit=None):
+    """Get example IDs from database, sorted and limited by SQLite"""
     cursor = conn.cursor()
 
     query = """
@@ -392,11 +360,121 @@ def get_example_ids(conn, mixes_filter=None):
         query += f" AND r.Mix IN ({placeholders})"
         params.extend(mixes_filter)
 
-    query += " ORDER BY r.cusum_min_correct ASC"
+    query += record_order_sql(sort_by, sort_order, prefix='r.')
+    if limit:
+        query += " LIMIT ?"
+        params.append(limit)
 
     cursor.execute(query, params)
     return cursor.fetchall()
 
+def prunes_default_flattened(args):
+    """Whether records already flattened by the default method can be skipped
+
+    The CUSUM minimum never increases with k, so when both methods are CUSUM and
+    test k >= default k, a record the default flattens is flattened by the test
+    as well and its flattening decision cannot change.
+    """
+    return (not args.use_default_derivative and not args.use_test_derivative
+            and args.test_k >= args.default_k)
+
+def iter_record_blocks(conn, records, use_db_default):
+    """Yield (block_size, block) for consecutive blocks of CUSUM_BATCH_SIZE records
+
+    Readings are fetched with one SELECT per batch of IDs rather than one per
+    record (the stored CUSUM row comes from the same SELECT when the default
+    uses it). block holds (record_id, db_cusum_min, readings, cusum_cells) for
+    the records with at least 10 readings.
+    """
+    for start in range(0, len(records), CUSUM_BATCH_SIZE):
+        block = records[start:start + CUSUM_BATCH_SIZE]
+        block_ids = [record_id for record_id, _ in block]
+        if use_db_default:
+            id_rows = iter_readings_and_cusum_for_ids(conn, block_ids)
+        else:
+            id_rows = ((record_id, readings, ())
+                       for record_id, readings in iter_readings_for_ids(conn, block_ids, table='all_readings'))
+        yield len(block), [(record_id, db_cusum_min, readings, cusum_cells)
+                           for (record_id, db_cusum_min), (_, readings, cusum_cells) in zip(block, id_rows)
+                           if len(readings) >= 10]
+
+def find_block_changes(item, args, cusum_threshold):
+    """Find the records in one block whose flattening decision changes
+
+    Takes a (block_size, block) item from iter_record_blocks and returns
+    (block_size, changing records). Module-level so it can be pickled for
+    ProcessPoolExecutor workers.
+    """
+    block_size, block = item
+    
+    # CUSUM is only computed here for methods that are not derivative-based
+    # (default k=0.0 reuses the values stored in the database)
+    compute_default_cusum = not args.use_default_derivative and args.default_k != 0.0
+    compute_test_cusum = not args.use_test_derivative
+    block_readings = [readings for _, _, readings, _ in block]
+    
+    default_cusums = batch_cusum(block_readings, args.default_k) if compute_default_cusum else [None] * len(block)
+    if compute_default_cusum and prunes_default_flattened(args):
+        # Skip the test CUSUM for records the default already flattens
+        kept = [(row, default_cusum) for row, default_cusum in zip(block, default_cusums)
+                if default_cusum[1] > cusum_threshold]
+        block = [row for row, _ in kept]
+        default_cusums = [default_cusum for _, default_cusum in kept]
+        block_readings = [readings for _, _, readings, _ in block]
+    test_cusums = batch_cusum(block_readings, args.test_k) if compute_test_cusum else [None] * len(block)
+    
+    block_changes = []
+    for (record_id, db_cusum_min, readings, cusum_cells), default_cusum, test_cusum in \
+            zip(block, default_cusums, test_cusums):
+        try:
+            # Calculate values for default comparison
+            if args.use_default_derivative:
+                # Use derivative for default
+                default_min, default_min_index = find_derivative_minimum(readings)
+                # Pad derivative values to match readings length for visualization
+                # (0 at start since derivative is 1 shorter)
+                default_values = np.concatenate(([0.0], compute_derivative(readings)))
+            elif args.default_k == 0.0:
+                # Use database values for default k=0.0 (fetched together with the readings)
+                default_min = bytes_to_float(db_cusum_min)
+                default_values = bytes_to_floats(cusum_cells[:len(readings)])
+                default_min_index = int(default_values.argmin()) if default_values.size else 0
+            else:
+                # CUSUM with default k parameter (computed for the whole block above)
+                default_values, default_min, default_min_index = default_cusum
+            
+            # Calculate values for test comparison
+            if args.use_test_derivative:
+                # Use derivative for test
+                test_min, test_min_index = find_derivative_minimum(readings)
+                # Pad derivative values to match readings length for visualization
+                # (0 at start since derivative is 1 shorter)
+                test_values = np.concatenate(([0.0], compute_derivative(readings)))
+            else:
+                # CUSUM with test k parameter (computed for the whole block above)
+                test_values, test_min, test_min_index = test_cusum
+            
+            # Check if flattening decision changes
+            if args.use_default_derivative:
+                default_flattened = default_min <= args.derivative_threshold
+            else:
+                default_flattened = default_min <= cusum_threshold
+            
+            if args.use_test_derivative:
+                test_flattened = test_min <= args.derivative_threshold
+            else:
+                test_flattened = test_min <= cusum_threshold
+            
+            if default_flattened != test_flattened:
+                block_changes.append((record_id, readings, default_values, test_values, 
+                                      default_min, test_min, default_min_index, test_min_index))
+            
+        except Exception as e:
+            print(f"Error processing ID {record_id}: {e}")
+            continue
+    
+    return block_size, block_changes
+
 def main():
     parser = argparse.ArgumentParser(description='Compare CUSUM behavior between different k parameters or derivative-based analysis')
     parser.add_argument('--default-k', type=float, default=0.0, 
@@ -439,6 +517,8 @@ def main():
                        help='Filter results: "threshold" = would flatten, "sanity" = sanity failures, "sanity-lob" = LOB sanity failures, "changes" = flattening decision changes (default behavior)')
     parser.add_argument('--mixes', type=str,
                        help='Comma-separated list of mix names to include (default: all mixes)')
+    parser.add_argument('--workers', type=int, default=1,
+                       help='Number of worker processes for CUSUM computation (default: 1 = no multiprocessing)')
 
     args = parser.parse_args()
 
@@ -495,12 +575,23 @@ def main():
     else:
         output_file = os.path.join(args.output, f"comparison_all_{default_str}_vs_{test_str}_{limit_str}.html")
     
-    conn = sqlite3.connect(db_path)
+    # Build the record-selection index on a short-lived read/write connection
+    conn = sqlite3.connect(os.path.expanduser(db_path))
+    # Record selection filters on in_use, cusum_min_correct and optionally Mix;
+    # the index also covers the selected (id, cusum_min_correct) columns
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_all_readings_in_use_mix_cusum "
+                 "ON all_readings(in_use, Mix, cusum_min_correct)")
+    conn.commit()
+    conn.execute("PRAGMA optimize")
+    conn.close()
+    
+    # Report-only job: read-only connection with a large page cache and mmap
+    conn = connect_read_only(db_path)
     
     # Determine which records to process
     if args.example_dataset:
         print("Using example dataset from feedback plots...")
-        records = get_example_ids(conn, mixes_filter)
+        records = get_example_ids(conn, mixes_filter, args.sort_by, args.sort_order, args.limit)
         file_type = "Example Dataset"
     elif args.ids:
         print(f"Processing specific IDs: {args.ids}")
@@ -521,7 +612,10 @@ def main():
             query += f" AND Mix IN ({mix_placeholders})"
             params.extend(mixes_filter)
 
-        query += " ORDER BY cusum_min_correct ASC"
+        query += record_order_sql(args.sort_by, args.sort_order)
+        if args.limit:
+            query += " LIMIT ?"
+            params.append(args.limit)
         query = query.format(id_placeholders=id_placeholders)
 
         cursor.execute(query, params)
@@ -529,18 +623,11 @@ def main():
         file_type = "Custom IDs"
     else:
         print("Processing all records...")
-        records = get_all_records(conn, mixes_filter)
+        records = get_all_records(conn, mixes_filter, args.sort_by, args.sort_order, args.limit)
         file_type = "All Records"
     
-    # Apply sorting if needed
-    if args.sort_by == 'id':
-        records.sort(key=lambda x: x[0], reverse=(args.sort_order == 'down'))
-    elif args.sort_by == 'cusum':
-        records.sort(key=lambda x: x[1], reverse=(args.sort_order == 'down'))
-    
-    # Apply limit if specified
+    # Sorting and limit are applied by SQLite (LIMIT stops the scan early)
     if args.limit:
-        records = records[:args.limit]
         print(f"Limited to {args.limit} records")
     
     # Print processing info
@@ -552,64 +639,31 @@ def main():
     # Process records and find ones where flattening decision changes
     changing_records = []
     
-    for record_id, db_cusum_min in tqdm(records, desc="Finding records with flattening changes"):
-        try:
-            # Get readings
-            readings = get_readings_for_id(conn, record_id)
-            
-            if len(readings) < 10:
-                continue
-            
-            # Calculate values for default comparison
-            if args.use_default_derivative:
-                # Use derivative for default
-                default_min, default_min_index = find_derivative_minimum(readings)
-                default_values = compute_derivative(readings)
-                # Pad derivative values to match readings length for visualization
-                default_values = [0] + default_values  # Add 0 at start since derivative is 1 shorter
-            elif args.default_k == 0.0:
-                # Use database values for default k=0.0
-                default_min = bytes_to_float(db_cusum_min)
-                # Get database CUSUM values
-                cursor = conn.cursor()
-                cusum_columns = [f"cusum{j}" for j in range(len(readings))]
-                cusum_select = ", ".join(cusum_columns)
-                cursor.execute(f"SELECT {cusum_select} FROM all_readings WHERE id = ?", (record_id,))
-                cusum_row = cursor.fetchone()
-                default_values = [bytes_to_float(val) for val in cusum_row if val is not None][:len(readings)]
-            else:
-                # Calculate CUSUM with default k parameter
-                default_values, default_min = apply_corrected_cusum_algorithm(readings, k=args.default_k)
-            
-            # Calculate values for test comparison
-            if args.use_test_derivative:
-                # Use derivative for test
-                test_min, test_min_index = find_derivative_minimum(readings)
-                test_values = compute_derivative(readings)
-                # Pad derivative values to match readings length for visualization
-                test_values = [0] + test_values  # Add 0 at start since derivative is 1 shorter
-            else:
-                # Calculate CUSUM with test k parameter
-                test_values, test_min = apply_corrected_cusum_algorithm(readings, k=args.test_k)
-            
-            # Check if flattening decision changes
-            if args.use_default_derivative:
-                default_flattened = default_min <= args.derivative_threshold
-            else:
-                default_flattened = default_min <= cusum_threshold
-            
-            if args.use_test_derivative:
-                test_flattened = test_min <= args.derivative_threshold
-            else:
-                test_flattened = test_min <= cusum_threshold
-            
-            if default_flattened != test_flattened:
-                changing_records.append((record_id, readings, default_values, test_values, 
-                                       default_min, test_min))
-                
-        except Exception as e:
-            print(f"Error processing ID {record_id}: {e}")
-            continue
+    # Records already flattened by a stored k=0.0 default are skipped before
+    # their readings are fetched (see prunes_default_flattened)
+    use_db_default = not args.use_default_derivative and args.default_k == 0.0
+    if use_db_default and prunes_default_flattened(args):
+        candidate_records = [(record_id, db_cusum_min) for record_id, db_cusum_min in records
+                             if bytes_to_float(db_cusum_min) > cusum_threshold]
+        print(f"Skipping {len(records) - len(candidate_records)} records already flattened at k={args.default_k}")
+        records = candidate_records
+    
+    # Block CUSUM and flattening decisions optionally fan out to worker processes
+    # while this process remains the only SQLite reader; at most two blocks per
+    # worker are in flight so readings stream in as results are consumed
+    blocks = iter_record_blocks(conn, records, use_db_default)
+    worker = partial(find_block_changes, args=args, cusum_threshold=cusum_threshold)
+    executor = ProcessPoolExecutor(max_workers=args.workers) if args.workers > 1 else None
+    results = bounded_map(executor, worker, blocks, window=2 * args.workers) if executor else map(worker, blocks)
+    
+    progress = tqdm(total=len(records), desc="Finding records with flattening changes")
+    for block_size, block_changes in results:
+        changing_records.extend(block_changes)
+        progress.update(block_size)
+    progress.close()
+    
+    if executor:
+        executor.shutdown()
     
     print(f"Found {len(changing_records)} records where flattening decision changes")
     
@@ -625,123 +679,122 @@ def generate_html_file(changing_records, output_file, file_type, args, threshold
     default_desc = "Derivative" if args.use_default_derivative else f"CUSUM k={args.default_k}"
     test_desc = "Derivative" if args.use_test_derivative else f"CUSUM k={args.test_k}"
     
-    # Start HTML
-    html_content = f'''
-    <!DOCTYPE html>
-    <html>
-    <head>
-        <title>Comparison: {default_desc} vs {test_desc} - {file_type}</title>
-        <style>
-            body {{
-                font-family: Arial, sans-serif;
-                margin: 10px;
-                background-color: #f5f5f5;
-            }}
-            .container {{
-                display: grid;
-                grid-template-columns: repeat(4, 1fr);
-                gap: 10px;
-                max-width: 1600px;
-                margin: 0 auto;
-            }}
-            .graph-container {{
-                background: white;
-                border: 1px solid #ddd;
-                border-radius: 4px;
-                padding: 6px;
-                text-align: center;
-            }}
-            .graph-header {{
-                font-size: 11px;
-                font-weight: bold;
-                margin-bottom: 4px;
-                color: #333;
-            }}
-            .status-indicator {{
-                margin-bottom: 6px;
-                padding: 2px;
-                border-radius: 2px;
-                font-size: 10px;
-                font-weight: bold;
-            }}
-            .header {{
-                text-align: center;
-                margin: 20px 0;
-            }}
-            .stats {{
-                background: white;
-                padding: 15px;
-                border-radius: 4px;
-                margin-bottom: 20px;
-                text-align: center;
-            }}
-            .legend {{
-                background: white;
-                padding: 10px;
-                border-radius: 4px;
-                margin-bottom: 20px;
-                text-align: center;
-                font-size: 12px;
-            }}
-        </style>
-    </head>
-    <body>
-        <div class="header">
-            <h1>Comparison: {default_desc} vs {test_desc}</h1>
-            <h2>{file_type}</h2>
-            <div class="stats">
-                <strong>Records with flattening changes:</strong> {len(changing_records)}<br>
-                <strong>Default method:</strong> {default_desc}<br>
-                <strong>Test method:</strong> {test_desc}<br>
-                <strong>Threshold:</strong> {"Derivative min ≤ " + str(args.derivative_threshold) if (args.use_default_derivative or args.use_test_derivative) else "CUSUM min ≤ " + str(threshold)}<br>
-                <strong>Showing:</strong> Only curves where flattening decision changes between methods
+    # Stream the report to disk graph by graph instead of growing one large string
+    with open(output_file, 'w', buffering=1 << 20) as f:
+        # Start HTML
+        f.write(f'''
+        <!DOCTYPE html>
+        <html>
+        <head>
+            <title>Comparison: {default_desc} vs {test_desc} - {file_type}</title>
+            <style>
+                body {{
+                    font-family: Arial, sans-serif;
+                    margin: 10px;
+                    background-color: #f5f5f5;
+                }}
+                .container {{
+                    display: grid;
+                    grid-template-columns: repeat(4, 1fr);
+                    gap: 10px;
+                    max-width: 1600px;
+                    margin: 0 auto;
+                }}
+                .graph-container {{
+                    background: white;
+                    border: 1px solid #ddd;
+                    border-radius: 4px;
+                    padding: 6px;
+                    text-align: center;
+                }}
+                .graph-header {{
+                    font-size: 11px;
+                    font-weight: bold;
+                    margin-bottom: 4px;
+                    color: #333;
+                }}
+                .status-indicator {{
+                    margin-bottom: 6px;
+                    padding: 2px;
+                    border-radius: 2px;
+                    font-size: 10px;
+                    font-weight: bold;
+                }}
+                .header {{
+                    text-align: center;
+                    margin: 20px 0;
+                }}
+                .stats {{
+                    background: white;
+                    padding: 15px;
+                    border-radius: 4px;
+                    margin-bottom: 20px;
+                    text-align: center;
+                }}
+                .legend {{
+                    background: white;
+                    padding: 10px;
+                    border-radius: 4px;
+                    margin-bottom: 20px;
+                    text-align: center;
+                    font-size: 12px;
+                }}
+            </style>
+        </head>
+        <body>
+            <div class="header">
+                <h1>Comparison: {default_desc} vs {test_desc}</h1>
+                <h2>{file_type}</h2>
+                <div class="stats">
+                    <strong>Records with flattening changes:</strong> {len(changing_records)}<br>
+                    <strong>Default method:</strong> {default_desc}<br>
+                    <strong>Test method:</strong> {test_desc}<br>
+                    <strong>Threshold:</strong> {"Derivative min ≤ " + str(args.derivative_threshold) if (args.use_default_derivative or args.use_test_derivative) else "CUSUM min ≤ " + str(threshold)}<br>
+                    <strong>Showing:</strong> Only curves where flattening decision changes between methods
+                </div>
+                <div class="legend">
+                    <strong>Curves:</strong> 
+                    <span style="color: blue;">■ Blue = Original Readings</span> | 
+                    <span style="color: green;">■ Green = Flattened Readings (if test method causes flattening)</span><br>
+                    <strong>Analysis:</strong>
+                    <span style="color: red;">■ Red Dashed = {default_desc}</span> | 
+                    <span style="color: orange;">■ Orange Dashed = {test_desc}</span><br>
+                    <strong>Markers:</strong>
+                    <span style="color: red;">● Red = {default_desc} Min</span> | 
+                    <span style="color: orange;">● Orange = {test_desc} Min</span> | 
+                    <span style="color: lime;">● Lime = Flattening Point</span><br>
+                    <strong>Status:</strong>
+                    <span style="color: #e74c3c;">■ Red = Lost Flattening</span> | 
+                    <span style="color: #27ae60;">■ Green = Gained Flattening</span>
+                </div>
             </div>
-            <div class="legend">
-                <strong>Curves:</strong> 
-                <span style="color: blue;">■ Blue = Original Readings</span> | 
-                <span style="color: green;">■ Green = Flattened Readings (if test method causes flattening)</span><br>
-                <strong>Analysis:</strong>
-                <span style="color: red;">■ Red Dashed = {default_desc}</span> | 
-                <span style="color: orange;">■ Orange Dashed = {test_desc}</span><br>
-                <strong>Markers:</strong>
-                <span style="color: red;">● Red = {default_desc} Min</span> | 
-                <span style="color: orange;">● Orange = {test_desc} Min</span> | 
-                <span style="color: lime;">● Lime = Flattening Point</span><br>
-                <strong>Status:</strong>
-                <span style="color: #e74c3c;">■ Red = Lost Flattening</span> | 
-                <span style="color: #27ae60;">■ Green = Gained Flattening</span>
-            </div>
-        </div>
-        <div class="container">
-    '''
-    
-    # Generate graphs for changing records
-    for record_id, readings, default_values, test_values, default_min, test_min in changing_records:
-        try:
-            svg_graph = generate_svg_comparison_graph(
-                record_id, readings, default_values, test_values,
-                default_min, test_min, args, threshold
-            )
-            html_content += svg_graph
+            <div class="container">
+        ''')
+    
+        # Generate graphs for changing records
+        for record_id, readings, default_values, test_values, default_min, test_min, \
+                default_min_index, test_min_index in changing_records:
+            try:
+                svg_graph = generate_svg_comparison_graph(
+                    record_id, readings, default_values, test_values,
+                    default_min, test_min, default_min_index, test_min_index, args, threshold
+                )
+                f.write(svg_graph)
             
-        except Exception as e:
-            print(f"Error generating graph for ID {record_id}: {e}")
-            continue
-    
-    # Close HTML
-    html_content += f'''
-        </div>
-        <div style="text-align: center; margin: 20px; color: #666;">
-            <p>K Comparison: {len(changing_records)} curves where flattening decision changes</p>
-            <p>{default_desc} vs {test_desc} with threshold ≤ {args.derivative_threshold if (args.use_default_derivative or args.use_test_derivative) else threshold}</p>
-        </div>
-    </body>
-    </html>
-    '''
+            except Exception as e:
+                print(f"Error generating graph for ID {record_id}: {e}")
+                continue
     
-    # Write file
-    with open(output_file, 'w') as f:
-        f.write(html_content)
+        # Close HTML
+        f.write(f'''
+            </div>
+            <div style="text-align: center; margin: 20px; color: #666;">
+                <p>K Comparison: {len(changing_records)} curves where flattening decision changes</p>
+                <p>{default_desc} vs {test_desc} with threshold ≤ {args.derivative_threshold if (args.use_default_derivative or args.use_test_derivative) else threshold}</p>
+            </div>
+        </body>
+        </html>
+        ''')
     
     print(f"K comparison HTML file generated: {output_file}")
     print(f"Records with flattening changes: {len(changing_records)}")
@@ -4,6 +4,33 @@ import csv
 import sqlite3
 import sys
 import os
+from operator import itemgetter
+
+# Import from utils
+try:
+    from utils.database import configure_bulk_load
+except ModuleNotFoundError:
+    from flatten.utils.database import configure_bulk_load
+
+# Rows buffered per executemany() call during the CSV load
+INSERT_BATCH_SIZE = 10000
+
+# CSV columns mapped to the readings schema, in table order:
+#   0=Sample, 1=File, 2=FileUID, 3=Extension, 4=Parser, 5=Mix,
+#   6=Mix:Target, 7=MixTarget, 8=MixDetector, 10=Group, 11=Target,
+#   12=Detector, 15=Type, 16=Role, 17=Tube, 20=ActiveLearnerResponse,
+#   23=AzureCls, 24=AzureAmb, 25=AzureCFD, 28=Embed.Cls, 29=Embed.CFD,
+#   31=Results, 32-75=readings0-43
+# Short rows are padded with None up to CSV_WIDTH so missing cells load as NULL.
+TEXT_COLUMNS = itemgetter(0, 1, 2, 3, 4, 5, 6, 7, 8, 10, 11, 12, 15, 16, 17)
+INT_COLUMNS = itemgetter(20, 23, 24)
+FLOAT_COLUMNS = itemgetter(25, 28, 29, 31)
+READINGS_COLUMNS = itemgetter(*range(32, 76))
+CSV_WIDTH = 76
+
+def parse_float(value):
+    """Parse a numeric CSV cell; missing or blank cells become None"""
+    return float(value) if value and value.strip() else None
 
 def create_database():
     csv_file = '/home/azureuser/code/wssvc-flow/data-4thAug2025-for_neg_filter.csv'
@@ -13,8 +40,9 @@ def create_database():
     if os.path.exists(db_file):
         os.remove(db_file)
     
-    # Connect to SQLite
+    # Connect to SQLite (fresh file, so no journal or fsync during the load)
     conn = sqlite3.connect(db_file)
+    configure_bulk_load(conn)
     cursor = conn.cursor()
     
     # Create table with schema based on manual analysis
@@ -90,61 +118,45 @@ def create_database():
     '''
     
     cursor.execute(create_table_sql)
+    num_columns = len(cursor.execute("PRAGMA table_info(readings)").fetchall())
+    insert_sql = f"INSERT INTO readings VALUES ({','.join(['?'] * num_columns)})"
     
-    # Read and insert data
-    with open(csv_file, 'r') as f:
+    # Read and insert data in one transaction, batched through executemany
+    with conn, open(csv_file, 'r') as f:
         reader = csv.reader(f)
         header = next(reader)  # Skip header
         
         row_count = 0
+        batch = []
         for row in reader:
-            # Extract only the columns with data, mapping to our schema
-            # Columns: 0=Sample, 1=File, 2=FileUID, 3=Extension, 4=Parser, 5=Mix, 
-            #         6=Mix:Target, 7=MixTarget, 8=MixDetector, 10=Group, 11=Target, 
-            #         12=Detector, 15=Type, 16=Role, 17=Tube, 20=ActiveLearnerResponse,
-            #         23=AzureCls, 24=AzureAmb, 25=AzureCFD, 28=Embed.Cls, 29=Embed.CFD,
-            #         31=Results, 32-75=readings0-43
+            if len(row) < CSV_WIDTH:
+                row += [None] * (CSV_WIDTH - len(row))
+            
+            # The 44 readings dominate parse time: a complete block is converted in
+            # one C-level map(float) pass, and only blocks with gaps go cell by cell
+            readings = READINGS_COLUMNS(row)
+            try:
+                readings = list(map(float, readings))
+            except (TypeError, ValueError):
+                readings = [parse_float(value) for value in readings]
             
             values = [
-                row[0] if len(row) > 0 else None,   # Sample
-                row[1] if len(row) > 1 else None,   # File
-                row[2] if len(row) > 2 else None,   # FileUID
-                row[3] if len(row) > 3 else None,   # Extension
-                row[4] if len(row) > 4 else None,   # Parser
-                row[5] if len(row) > 5 else None,   # Mix
-                row[6] if len(row) > 6 else None,   # Mix:Target
-                row[7] if len(row) > 7 else None,   # MixTarget
-                row[8] if len(row) > 8 else None,   # MixDetector
-                row[10] if len(row) > 10 else None, # Group
-                row[11] if len(row) > 11 else None, # Target
-                row[12] if len(row) > 12 else None, # Detector
-                row[15] if len(row) > 15 else None, # Type
-                row[16] if len(row) > 16 else None, # Role
-                row[17] if len(row) > 17 else None, # Tube
-                int(row[20]) if len(row) > 20 and row[20].strip() else None, # ActiveLearnerResponse
-                int(row[23]) if len(row) > 23 and row[23].strip() else None, # AzureCls
-                int(row[24]) if len(row) > 24 and row[24].strip() else None, # AzureAmb
-                float(row[25]) if len(row) > 25 and row[25].strip() else None, # AzureCFD
-                float(row[28]) if len(row) > 28 and row[28].strip() else None, # Embed.Cls
-                float(row[29]) if len(row) > 29 and row[29].strip() else None, # Embed.CFD
-                float(row[31]) if len(row) > 31 and row[31].strip() else None, # Results
+                *TEXT_COLUMNS(row),
+                *[int(value) if value and value.strip() else None for value in INT_COLUMNS(row)],
+                *[parse_float(value) for value in FLOAT_COLUMNS(row)],
+                *readings,
             ]
             
-            # Add readings columns (32-75 = readings0-43)
-            for i in range(32, 76):
-                if len(row) > i and row[i].strip():
-                    values.append(float(row[i]))
-                else:
-                    values.append(None)
-            
-            placeholders = ','.join(['?' for _ in values])
-            cursor.execute(f'INSERT INTO readings VALUES ({placeholders})', values)
-            
+            batch.append(values)
             row_count += 1
-            if row_count % 1000 == 0:
+            if len(batch) >= INSERT_BATCH_SIZE:
+                cursor.executemany(insert_sql, batch)
+                batch.clear()
                 print(f"Inserted {row_count} rows...")
+        
+        if batch:
+            cursor.executemany(insert_sql, batch)
     
-    conn.commit()
     print(f"Database created successfully with {row_count} rows")
     print(f"Database file: {db_file}")
     
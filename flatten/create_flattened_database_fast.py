@@ -2,9 +2,51 @@
 
 import sqlite3
 import numpy as np
-import random
 import argparse
-from scipy import stats
+
+# Import from utils
+try:
+    from utils.database import configure_bulk_write, blob_to_array
+except ModuleNotFoundError:
+    from flatten.utils.database import configure_bulk_write, blob_to_array
+
+# Random source for the flattening noise
+_rng = np.random.default_rng()
+
+# Temp table holding one batch of flattened rows for the set-based UPDATE
+UPDATES_TABLE = "temp.flatten_updates"
+
+# Rows fetched and converted to NumPy per fetchmany() call
+FETCH_BATCH_SIZE = 10000
+
+# Columns rewritten for each flattened record, and the statements that stage
+# them (built once so every batch reuses the cached prepared statements)
+_UPDATE_COLUMNS = ["Results"] + [f"readings{i}" for i in range(44)]
+_STAGE_CLEAR_SQL = f"DELETE FROM {UPDATES_TABLE}"
+_STAGE_INSERT_SQL = f"INSERT INTO {UPDATES_TABLE} VALUES ({', '.join(['?'] * (len(_UPDATE_COLUMNS) + 1))})"
+
+def compact_rows(values):
+    """Move the non-NaN cells of each row to the front, keeping their order
+
+    Row-wise equivalent of dropping the None cells from each record.
+    """
+    order = np.argsort(np.isnan(values), axis=1, kind='stable')
+    return np.take_along_axis(values, order, axis=1)
+
+def records_to_array(fetched, cusum_blob=False):
+    """Convert fetched rows to an (N, 90) float64 array with NULL cells as NaN
+
+    With cusum_blob the row ends in a float32 cusum_array BLOB, which is
+    decoded into columns 46-89 (NaN-padded) in place of cusum0-cusum43.
+    """
+    if not cusum_blob:
+        return np.array(fetched, dtype=np.float64).reshape(-1, 90)
+    block = np.full((len(fetched), 90), np.nan)
+    block[:, :46] = np.array([record[:46] for record in fetched], dtype=np.float64).reshape(-1, 46)
+    for i, record in enumerate(fetched):
+        values = blob_to_array(record[46])[:44]
+        block[i, 46:46 + len(values)] = values
+    return block
 
 def get_example_ids(conn):
     """Get example IDs from database"""
@@ -63,31 +105,61 @@ def main():
                        help='Source table to read from (default: readings)')
     parser.add_argument('--dest-table', type=str, default='flatten',
                        help='Destination table to write to (default: flatten)')
+    parser.add_argument('--batch-size', type=int, default=50000,
+                       help='Flattened rows written per UPDATE batch (default: 50000)')
+    parser.add_argument('--cusum-blob', action='store_true',
+                       help='Read CUSUM values from the float32 cusum_array BLOB instead of cusum0-cusum43')
+    parser.add_argument('--in-place', action='store_true',
+                       help='Flatten the source table itself instead of a copy (overwrites its readings)')
 
     args = parser.parse_args()
     
     # Use threshold if specified (overrides cusum-limit)
     cusum_threshold = args.threshold if args.threshold != -80 else args.cusum_limit
+    dest_table = args.source_table if args.in_place else args.dest_table
 
     print(f"Database: {args.db}")
     print(f"Source table: {args.source_table}")
-    print(f"Destination table: {args.dest_table}")
+    print(f"Destination table: {dest_table}")
     print(f"CUSUM threshold: {cusum_threshold}")
     print(f"Sort by: {args.sort_by}, order: {args.sort_order}")
 
     conn = sqlite3.connect(args.db)
+    configure_bulk_write(conn)
+    # Single-writer job: hold the file lock for the whole run and checkpoint the
+    # WAL once at the end instead of after the table copy and again after the updates
+    conn.execute("PRAGMA locking_mode=EXCLUSIVE")
+    conn.execute("PRAGMA wal_autocheckpoint=0")
     cursor = conn.cursor()
 
-    print(f"Creating {args.dest_table} table copy from {args.source_table}...")
+    if args.in_place:
+        # Rewrite only the flattened rows of the source table; they are committed
+        # in one transaction at the end, so a failed run leaves it untouched
+        print(f"Flattening {dest_table} in place...")
+    else:
+        print(f"Creating {dest_table} table copy from {args.source_table}...")
 
-    # Create the destination table as a copy of the source
-    cursor.execute(f"DROP TABLE IF EXISTS {args.dest_table}")
-    cursor.execute(f"CREATE TABLE {args.dest_table} AS SELECT * FROM {args.source_table}")
+        # Create the destination table as a copy of the source
+        cursor.execute(f"DROP TABLE IF EXISTS {dest_table}")
+        cursor.execute(f"CREATE TABLE {dest_table} AS SELECT * FROM {args.source_table}")
+        # CREATE TABLE AS keeps no keys: index id for the UPDATE ... FROM lookups
+        cursor.execute(f"CREATE INDEX IF NOT EXISTS idx_{dest_table}_id ON {dest_table}(id)")
+        # Index the candidate filter/sort columns for the SELECT (only on the copy,
+        # so --in-place leaves no new index on the source table)
+        cursor.execute(f"CREATE INDEX IF NOT EXISTS idx_{dest_table}_in_use_cusum "
+                       f"ON {dest_table}(in_use, cusum_min_correct)")
+    create_updates_table(cursor)
+    update_sql = build_update_sql(dest_table)
     
     print("Processing flattening with optimized approach...")
     
     # Build WHERE clause based on options
     where_conditions = ["in_use = 1", "cusum_min_correct IS NOT NULL", f"cusum_min_correct <= {cusum_threshold}"]
+    if not args.cusum_blob and not args.limit:
+        # cusum0 is always 0, so a minimum at index 1 means cusum1 holds it; those
+        # records are never flattened, so do not fetch them. Skipped with --limit,
+        # which must still pick the first N records by the requested order
+        where_conditions.append("cusum1 IS NOT cusum_min_correct")
     
     # Handle ID selection
     if args.ids:
@@ -116,6 +188,12 @@ def main():
     else:  # id
         order_by = f"id {'DESC' if args.sort_order == 'down' else 'ASC'}"
     
+    # CUSUM values come either from the 44 cusum columns or the single cusum_array BLOB
+    if args.cusum_blob:
+        cusum_select = "cusum_array"
+    else:
+        cusum_select = ", ".join(f"cusum{i}" for i in range(44))
+    
     # Build query
     query = f"""
     SELECT id, cusum_min_correct,
@@ -124,12 +202,8 @@ def main():
            readings20, readings21, readings22, readings23, readings24, readings25, readings26, readings27, readings28, readings29,
            readings30, readings31, readings32, readings33, readings34, readings35, readings36, readings37, readings38, readings39,
            readings40, readings41, readings42, readings43,
-           cusum0, cusum1, cusum2, cusum3, cusum4, cusum5, cusum6, cusum7, cusum8, cusum9,
-           cusum10, cusum11, cusum12, cusum13, cusum14, cusum15, cusum16, cusum17, cusum18, cusum19,
-           cusum20, cusum21, cusum22, cusum23, cusum24, cusum25, cusum26, cusum27, cusum28, cusum29,
-           cusum30, cusum31, cusum32, cusum33, cusum34, cusum35, cusum36, cusum37, cusum38, cusum39,
-           cusum40, cusum41, cusum42, cusum43
-    FROM {args.dest_table}
+           {cusum_select}
+    FROM {dest_table}
     WHERE {where_clause}
     ORDER BY {order_by}
     """
@@ -141,107 +215,85 @@ def main():
     # Execute query
     cursor.execute(query, query_params)
     
-    records = cursor.fetchall()
+    # Stream the selection in FETCH_BATCH_SIZE chunks, converting each to NumPy,
+    # so only one chunk of per-row tuples of boxed floats is alive at a time
+    cursor.arraysize = FETCH_BATCH_SIZE
+    blocks = [records_to_array(fetched, args.cusum_blob) for fetched in iter(cursor.fetchmany, [])]
+    records = np.concatenate(blocks) if blocks else np.empty((0, 90))
+    del blocks
     print(f"Found {len(records)} records that need flattening (CUSUM <= -80)...")
     
-    flattened_count = 0
-    sanity_failed_count = 0
-    batch_updates = []
+    record_ids = records[:, 0].astype(np.int64)
     
-    for record in records:
-        try:
-            record_id = record[0]
-            cusum_min = record[1]
-            
-            # Extract readings (skip None values)
-            readings_raw = record[2:46]  # readings0 to readings43
-            readings = [r for r in readings_raw if r is not None]
-            
-            if len(readings) < 10:
-                continue
-            
-            # Extract CUSUM values (skip None values)
-            cusum_raw = record[46:90]  # cusum0 to cusum43
-            cusum_values = [c for c in cusum_raw if c is not None][:len(readings)]
-            
-            # Find CUSUM minimum index
-            min_val = min(cusum_values)
-            min_index = cusum_values.index(min_val)
-            
-            # Skip if minimum occurs too early
-            if min_index <= 1:
-                continue
-            
-            # Get target reading
-            target_reading = readings[min_index]
-            
-            # Sanity check: ensure the CUSUM min point actually represents a decrease
-            if args.sanity_check_slope:
-                # Check if min_index is in first five cycles
-                if min_index < 5:
-                    # For first five cycles, compare with average of first two
-                    avg_first = np.mean(readings[:2])
-                else:
-                    # Otherwise, compare with average of first five cycles
-                    avg_first = np.mean(readings[:5])
-                
-                # Skip if the reading at cusum min is not lower than the early average
-                if target_reading >= avg_first:
-                    sanity_failed_count += 1
-                    continue
-            
-            if args.sanity_lob:
-                # Line of Best Fit sanity check: check gradient from first to CUSUM min
-                # Use readings from index 0 to min_index (inclusive)
-                x_values = np.arange(min_index + 1)
-                y_values = readings[:min_index + 1]
-                
-                # Calculate line of best fit using scipy.stats.linregress
-                slope, intercept, r_value, p_value, std_err = stats.linregress(x_values, y_values)
-                
-                # Check if gradient is negative (downward trend)
-                if slope >= 0:
-                    sanity_failed_count += 1
-                    continue
-            reading_std = np.std(readings)
-            noise_scale = reading_std * 0.001
-            
-            flattened_readings = readings.copy()
-            
-            # Flatten readings before minimum point
-            for i in range(min_index):
-                noise = random.uniform(-noise_scale, noise_scale)
-                flattened_readings[i] = target_reading + noise
-            
-            # Create new Results value
-            pre_flatten_reading = readings[max(0, min_index - 1)]
-            results_noise = random.uniform(-noise_scale, noise_scale)
-            new_results_value = pre_flatten_reading + results_noise
-            
-            # Pad flattened readings
-            padded_readings = flattened_readings + [None] * (44 - len(flattened_readings))
-            
-            # Add to batch
-            batch_updates.append([new_results_value] + padded_readings + [record_id])
-            flattened_count += 1
-            
-            # Process in batches of 1000
-            if len(batch_updates) >= 1000:
-                print(f"Processing batch... ({flattened_count} flattened so far)")
-                process_batch(cursor, batch_updates, args.dest_table)
-                batch_updates = []
-
-        except Exception as e:
-            print(f"Error processing ID {record[0]}: {e}")
-            continue
-
-    # Process remaining batch
-    if batch_updates:
-        print(f"Processing final batch...")
-        process_batch(cursor, batch_updates, args.dest_table)
+    # Readings and CUSUM values as (N, 44) arrays, NULLs moved to the end of each row
+    readings = compact_rows(records[:, 2:46])
+    cusum = compact_rows(records[:, 46:90])
+    rows = np.arange(len(records))
+    columns = np.arange(44)
     
-    # Commit changes
+    num_readings = np.count_nonzero(~np.isnan(readings), axis=1)
+    
+    # CUSUM minimum over the values that have a matching reading (first one on ties)
+    cusum[(columns >= num_readings[:, None]) | np.isnan(cusum)] = np.inf
+    min_index = np.argmin(cusum, axis=1)
+    target_reading = readings[rows, min_index]
+    
+    # Need at least 10 readings and a minimum that does not occur too early
+    eligible = (num_readings >= 10) & np.isfinite(cusum[rows, min_index]) & (min_index > 1)
+    sanity_failed = np.zeros(len(records), dtype=bool)
+    
+    # Sanity check: ensure the CUSUM min point actually represents a decrease
+    if args.sanity_check_slope:
+        # Within the first five cycles compare with the average of the first two,
+        # otherwise with the average of the first five
+        avg_first = np.where(min_index < 5, readings[:, :2].mean(axis=1), readings[:, :5].mean(axis=1))
+        sanity_failed |= target_reading >= avg_first
+    
+    if args.sanity_lob:
+        # Line of Best Fit sanity check: gradient of readings[0..min_index] against
+        # the cycle index. Only its sign matters and the least-squares denominator
+        # is positive, so n * sum(xy) - sum(x) * sum(y) is compared instead
+        n = min_index + 1
+        y_values = np.where(columns < n[:, None], readings, 0.0)
+        gradient_numerator = n * (y_values @ columns) - n * (n - 1) / 2 * y_values.sum(axis=1)
+        
+        # Skip unless the gradient is negative (downward trend)
+        sanity_failed |= gradient_numerator >= 0
+    
+    sanity_failed_count = int(np.count_nonzero(eligible & sanity_failed))
+    selected = np.flatnonzero(eligible & ~sanity_failed)
+    
+    # Flatten readings before the minimum point to the target reading plus noise,
+    # and set Results to the reading before the minimum plus noise
+    selected_min = min_index[selected]
+    noise_scale = np.nanstd(readings[selected], axis=1) * 0.001
+    noise = _rng.uniform(-noise_scale[:, None], noise_scale[:, None], size=(len(selected), 45))
+    flattened = np.where(columns < selected_min[:, None],
+                         target_reading[selected, None] + noise[:, :44],
+                         readings[selected])
+    new_results = readings[selected, selected_min - 1] + noise[:, 44]
+    
+    selected_ids = record_ids[selected]
+    flattened_count = len(selected)
+    
+    # Process in batches of --batch-size rows, building each batch's temp-table
+    # rows (Results, readings0-43, id) straight from the array slices. The NaN
+    # cells after each record's last reading bind as NULL, so no per-row None
+    # filtering or padding is needed
+    for start in range(0, flattened_count, args.batch_size):
+        stop = min(start + args.batch_size, flattened_count)
+        batch_updates = np.column_stack([new_results[start:stop], flattened[start:stop]]).tolist()
+        for row, record_id in zip(batch_updates, selected_ids[start:stop].tolist()):
+            row.append(record_id)
+        if stop - start == args.batch_size:
+            print(f"Processing batch... ({stop} flattened so far)")
+        else:
+            print(f"Processing final batch...")
+        process_batch(cursor, batch_updates, update_sql)
+    
+    # Commit changes and fold the WAL back into the database file
     conn.commit()
+    conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
     
     print(f"\nFlattening complete!")
     print(f"Records flattened: {flattened_count}")
@@ -252,19 +304,34 @@ def main():
     
     conn.close()
 
-def process_batch(cursor, batch_updates, dest_table):
-    """Process a batch of updates"""
-    update_query = f"""
+def create_updates_table(cursor):
+    """Create the temp table that stages each batch of flattened rows"""
+    readings_columns = ", ".join(f"readings{i} REAL" for i in range(44))
+    cursor.execute(f"""
+    CREATE TEMP TABLE IF NOT EXISTS {UPDATES_TABLE} (
+        Results REAL, {readings_columns}, id INTEGER PRIMARY KEY
+    )
+    """)
+
+def build_update_sql(dest_table):
+    """Build the set-based UPDATE that applies the staged rows to dest_table"""
+    return f"""
     UPDATE {dest_table}
-    SET Results = ?, readings0 = ?, readings1 = ?, readings2 = ?, readings3 = ?, readings4 = ?, readings5 = ?, readings6 = ?, readings7 = ?, readings8 = ?, readings9 = ?,
-        readings10 = ?, readings11 = ?, readings12 = ?, readings13 = ?, readings14 = ?, readings15 = ?, readings16 = ?, readings17 = ?, readings18 = ?, readings19 = ?,
-        readings20 = ?, readings21 = ?, readings22 = ?, readings23 = ?, readings24 = ?, readings25 = ?, readings26 = ?, readings27 = ?, readings28 = ?, readings29 = ?,
-        readings30 = ?, readings31 = ?, readings32 = ?, readings33 = ?, readings34 = ?, readings35 = ?, readings36 = ?, readings37 = ?, readings38 = ?, readings39 = ?,
-        readings40 = ?, readings41 = ?, readings42 = ?, readings43 = ?
-    WHERE id = ?
+    SET ({", ".join(_UPDATE_COLUMNS)}) = ({", ".join(f"u.{column}" for column in _UPDATE_COLUMNS)})
+    FROM {UPDATES_TABLE} AS u
+    WHERE {dest_table}.id = u.id
     """
 
-    cursor.executemany(update_query, batch_updates)
+def process_batch(cursor, batch_updates, update_sql):
+    """Process a batch of updates
+
+    The rows are staged in the temp table and applied with one set-based
+    UPDATE ... FROM join (update_sql, from build_update_sql) instead of one
+    UPDATE per row.
+    """
+    cursor.execute(_STAGE_CLEAR_SQL)
+    cursor.executemany(_STAGE_INSERT_SQL, batch_updates)
+    cursor.execute(update_sql)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -1,43 +1,135 @@
 """
 Algorithm utility functions for CUSUM and curve processing
 """
+from functools import lru_cache
+
 import numpy as np
 from scipy import stats
 
 def compute_negative_cusum(y_vals, k=0.0):
-    """Compute negative CUSUM with adjustable k parameter - matches original algorithm"""
-    cusum = [0]
-    for i in range(1, len(y_vals)):
-        diff = y_vals[i] - y_vals[i - 1]
-        s = min(0, cusum[-1] + (diff - k))
-        cusum.append(s)
-    return np.array(cusum)
+    """Compute negative CUSUM with adjustable k parameter - matches original algorithm
+
+    The clamp s[i] = min(0, s[i-1] + d[i]) is evaluated without branches as
+    the running sum of d minus its running maximum.
+    """
+    y_vals = np.asarray(y_vals, dtype=np.float64)
+    steps = np.zeros(max(len(y_vals), 1))
+    steps[1:] = np.diff(y_vals) - k
+    running = np.cumsum(steps)
+    return running - np.maximum.accumulate(running)
 
 def smooth_curve(y_vals, window_size=5):
     """Apply smoothing to curve data"""
     if len(y_vals) < window_size:
         return y_vals
     
-    smoothed = []
+    return centered_rolling_mean(y_vals, window_size)
+
+@lru_cache(maxsize=None)
+def rolling_window_bounds(n, window_size=5):
+    """Start/end indices and sizes of the shrinking centered windows for length n
+
+    Cached per (n, window_size); records almost always share the same length,
+    so the index arrays are built once. The arrays are read-only.
+    """
     half_window = window_size // 2
-    
-    for i in range(len(y_vals)):
-        start = max(0, i - half_window)
-        end = min(len(y_vals), i + half_window + 1)
-        smoothed.append(sum(y_vals[start:end]) / (end - start))
-    
-    return smoothed
+    idx = np.arange(n)
+    start = np.maximum(idx - half_window, 0)
+    end = np.minimum(idx + half_window + 1, n)
+    sizes = end - start
+    for bounds in (start, end, sizes):
+        bounds.setflags(write=False)
+    return start, end, sizes
+
+def centered_rolling_mean(y_vals, window_size=5):
+    """Centered rolling mean with edge windows shrunk to the available points
+
+    Equivalent to pandas ``rolling(window, min_periods=1, center=True).mean()``
+    for odd windows, computed in O(n) from a prefix sum.
+    """
+    y_vals = np.asarray(y_vals, dtype=np.float64)
+    start, end, sizes = rolling_window_bounds(len(y_vals), window_size)
+
+    prefix = np.concatenate(([0.0], np.cumsum(y_vals)))
+    return (prefix[end] - prefix[start]) / sizes
 
 def find_cusum_minimum_index(cusum_values):
     """Find the index where CUSUM reaches its minimum value"""
-    min_val = min(cusum_values)
-    return cusum_values.index(min_val)
+    return int(np.argmin(cusum_values))
 
 def calculate_lob_gradient(x_values, y_values):
     """Calculate Line of Best Fit gradient using linear regression"""
     slope, intercept, r_value, p_value, std_err = stats.linregress(x_values, y_values)
     return slope, intercept, r_value
 
+def population_std(values):
+    """Population standard deviation (as np.std) computed in plain Python
+
+    For the <= 44 readings of one record this avoids NumPy's array conversion
+    and dispatch overhead, which costs more than the arithmetic itself.
+    """
+    n = len(values)
+    mean = sum(values) / n
+    return (sum((value - mean) ** 2 for value in values) / n) ** 0.5
+
+def lob_gradient_numerator(y_values):
+    """Numerator of the Line of Best Fit gradient of y_values against 0..n-1
+
+    Equals sum((x - mean(x)) * (y - mean(y))), which has the same sign as the
+    least-squares slope; use it when only the direction of the trend matters.
+    """
+    y_values = np.asarray(y_values, dtype=np.float64)
+    x_values = np.arange(len(y_values), dtype=np.float64)
+    return float(np.dot(x_values - x_values.mean(), y_values - y_values.mean()))
+
+def cusum_pipeline(readings, k=0.0):
+    """Run the full corrected CUSUM pipeline on one record's readings
+
+    Single-record form of cusum_pipeline_batch. Returns (cusum, cusum_min).
+    """
+    readings = np.asarray(readings, dtype=np.float64)
+    cusum, cusum_min, _ = cusum_pipeline_batch(readings[np.newaxis, :], k=k)
+    return cusum[0], float(cusum_min[0])
+
+def cusum_pipeline_batch(readings, k=0.0):
+    """Run the corrected CUSUM pipeline on a 2-D array of equal-length records
+
+    Fuses the SVG scaling, inversion, centered 5-point smoothing and the
+    negative CUSUM recurrence into NumPy array operations along each row. The
+    recurrence s[i] = min(0, s[i-1] + d[i]) is evaluated in closed form as the
+    running sum of d minus its running maximum, so no per-element or
+    per-record Python loop remains.
+    Returns (cusum, cusum_min, cusum_argmin) with one row/entry per record.
+    """
+    margin = 50
+    plot_height = 400 - 2 * margin
+
+    readings = np.ascontiguousarray(readings, dtype=np.float64)
+    num_records, n = readings.shape
+    min_reading = readings.min(axis=1, keepdims=True)
+    reading_range = readings.max(axis=1, keepdims=True) - min_reading
+    reading_range[reading_range == 0] = 1
+
+    # SVG scaling followed by inversion. The SVG y of the minimum reading is
+    # margin + plot_height, so max(svg_y) - svg_y reduces to the scaled offset.
+    y_inv = (readings - min_reading) * (plot_height / reading_range)
+
+    # Centered 5-point rolling mean with shrinking edge windows (see centered_rolling_mean)
+    prefix = np.zeros((num_records, n + 1))
+    np.cumsum(y_inv, axis=1, out=prefix[:, 1:])
+    start, end, sizes = rolling_window_bounds(n, 5)
+    y_smooth = (prefix[:, end] - prefix[:, start]) / sizes
+
+    # Negative CUSUM: s[i] = P[i] - max(P[0..i]) where P is the running sum of (diff - k)
+    steps = np.empty_like(y_smooth)
+    steps[:, 0] = 0.0
+    np.subtract(y_smooth[:, 1:], y_smooth[:, :-1], out=steps[:, 1:])
+    steps[:, 1:] -= k
+    running = np.cumsum(steps, axis=1)
+    cusum = np.subtract(running, np.maximum.accumulate(running, axis=1), out=running)
+    cusum_argmin = cusum.argmin(axis=1)
+    return cusum, cusum[np.arange(num_records), cusum_argmin], cusum_argmin
+
 def apply_corrected_cusum_algorithm(readings, k=0.0):
     """Apply the corrected CUSUM algorithm with adjustable k parameter"""
     margin = 50
@@ -65,4 +157,4 @@ def apply_corrected_cusum_algorithm(readings, k=0.0):
     # Apply CUSUM with custom k parameter
     cusum = compute_negative_cusum(y_smooth, k=k)
     
-    return cusum, min(cusum)
\ No newline at end of file
+    return cusum, float(cusum.min())
\ No newline at end of file
@@ -3,6 +3,47 @@ Database utility functions for the wssvc-flow toolset
 """
 import sqlite3
 import struct
+from pathlib import Path
+
+import numpy as np
+
+def configure_bulk_write(conn):
+    """Apply PRAGMAs for bulk write jobs: WAL journal, relaxed fsync, in-memory temp store, 256 MiB cache and mmap"""
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    conn.execute("PRAGMA cache_size=-262144")
+    conn.execute("PRAGMA mmap_size=268435456")
+
+def configure_bulk_load(conn):
+    """Apply PRAGMAs for a one-shot load into a freshly created database file
+
+    No rollback journal and no fsync: a load that fails part-way leaves a file
+    that is deleted and rebuilt by the next run anyway. The file lock is taken
+    once and held until the connection closes.
+    """
+    conn.executescript("""
+        PRAGMA locking_mode=EXCLUSIVE;
+        PRAGMA journal_mode=OFF;
+        PRAGMA synchronous=OFF;
+        PRAGMA temp_store=MEMORY;
+        PRAGMA cache_size=-262144;
+    """)
+
+def configure_read_only(conn):
+    """Apply PRAGMAs for read-heavy report jobs: 256 MiB page cache, 1 GiB mmap, in-memory temp store, no writes"""
+    conn.executescript("""
+        PRAGMA cache_size=-262144;
+        PRAGMA mmap_size=1073741824;
+        PRAGMA temp_store=MEMORY;
+        PRAGMA query_only=1;
+    """)
+
+def connect_read_only(db_path):
+    """Open a database file read-only (mode=ro URI) with configure_read_only applied"""
+    conn = sqlite3.connect(f"{Path(db_path).expanduser().resolve().as_uri()}?mode=ro", uri=True)
+    configure_read_only(conn)
+    return conn
 
 def bytes_to_float(value):
     """Convert bytes to float if needed, otherwise return as-is"""
@@ -10,6 +51,36 @@ def bytes_to_float(value):
         return struct.unpack('d', value)[0]
     return value
 
+def bytes_to_floats(values):
+    """Convert a row of REAL or packed-double cells to a float64 array, skipping NULLs
+
+    When every cell is a packed double they are decoded in one np.frombuffer
+    call instead of one struct.unpack per cell.
+    """
+    cells = [v for v in values if v is not None]
+    if cells and all(isinstance(v, bytes) for v in cells):
+        return np.frombuffer(b''.join(cells), dtype=np.float64)
+    return np.array([bytes_to_float(v) for v in cells], dtype=np.float64)
+
+def ensure_blob_column(conn, table, column):
+    """Add a BLOB column to a table if it does not exist yet (one-shot migration)"""
+    cursor = conn.cursor()
+    cursor.execute(f"PRAGMA table_info({table})")
+    if column not in [row[1] for row in cursor.fetchall()]:
+        cursor.execute(f"ALTER TABLE {table} ADD COLUMN {column} BLOB")
+        conn.commit()
+        print(f"Added {column} BLOB column to {table}")
+
+def array_to_blob(values):
+    """Pack a numeric sequence into a little-endian float32 BLOB"""
+    return sqlite3.Binary(np.asarray(values, dtype='<f4').tobytes())
+
+def blob_to_array(blob):
+    """Decode a float32 BLOB written by array_to_blob into a NumPy array"""
+    if blob is None:
+        return np.empty(0, dtype='<f4')
+    return np.frombuffer(blob, dtype='<f4')
+
 def get_readings_for_id(conn, target_id, table='readings', num_readings=44):
     """Get readings for a specific ID from the database
     
@@ -29,6 +100,34 @@ def get_readings_for_id(conn, target_id, table='readings', num_readings=44):
     readings = [r for r in row if r is not None]
     return readings
 
+def readings_count_sql(num_readings=44):
+    """SQL expression counting the non-NULL readings columns of a row"""
+    return " + ".join(f"(readings{i} IS NOT NULL)" for i in range(num_readings))
+
+def iter_readings_for_ids(conn, ids, table='readings', num_readings=44, batch_size=900, dtype=None):
+    """Yield (id, readings) for many IDs using one SELECT per batch of IDs
+
+    IDs are yielded in the order given; IDs missing from the table yield an
+    empty list, matching get_readings_for_id. batch_size stays below SQLite's
+    default limit of 999 bound variables. If dtype is given, readings are
+    returned as a contiguous NumPy array of that dtype instead of a list.
+    """
+    cursor = conn.cursor()
+    readings_select = ", ".join(f"readings{i}" for i in range(num_readings))
+    for start in range(0, len(ids), batch_size):
+        batch = ids[start:start + batch_size]
+        placeholders = ','.join(['?'] * len(batch))
+        cursor.execute(f"SELECT id, {readings_select} FROM {table} WHERE id IN ({placeholders})", batch)
+        if dtype is None:
+            rows = {row[0]: [r for r in row[1:] if r is not None] for row in cursor.fetchall()}
+            missing = []
+        else:
+            rows = {row[0]: np.fromiter((r for r in row[1:] if r is not None), dtype=dtype)
+                    for row in cursor.fetchall()}
+            missing = np.empty(0, dtype=dtype)
+        for target_id in batch:
+            yield target_id, rows.get(target_id, missing)
+
 def get_example_ids(conn, sort_order='down'):
     """Get example IDs from database"""
     cursor = conn.cursor()
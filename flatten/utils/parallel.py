@@ -0,0 +1,26 @@
+"""
+Process pool utility functions
+"""
+from collections import deque
+from itertools import islice
+
+def _map_chunk(fn, chunk):
+    """Apply fn to each item of one submitted chunk (runs in the worker process)"""
+    return [fn(item) for item in chunk]
+
+def bounded_map(executor, fn, iterable, window, chunksize=1):
+    """Ordered executor.map that keeps at most window chunks in flight
+
+    Executor.map submits every item up front, draining a streaming input (and
+    holding all inputs and results in memory) before the first result is
+    used. Here the input is read lazily: a new chunk of chunksize items is
+    submitted only once the oldest pending chunk has been handed back.
+    """
+    items = iter(iterable)
+    pending = deque()
+    for chunk in iter(lambda: list(islice(items, chunksize)), []):
+        if len(pending) >= window:
+            yield from pending.popleft().result()
+        pending.append(executor.submit(_map_chunk, fn, chunk))
+    while pending:
+        yield from pending.popleft().result()
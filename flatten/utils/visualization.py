@@ -1,9 +1,11 @@
 """
 Visualization utility functions for SVG/HTML generation
 """
-import random
 import numpy as np
 
+# Random source for the flattening noise
+_rng = np.random.default_rng()
+
 def create_flattened_readings(original_readings, cusum_values, cusum_min, threshold=-80, 
                              sanity_check=False, sanity_lob=False, target_reading=None, 
                              min_index=None, avg_first=None, lob_gradient=None):
@@ -11,7 +13,7 @@ def create_flattened_readings(original_readings, cusum_values, cusum_min, thresh
     
     This is the consolidated version handling all sanity check types.
     """
-    from .algorithms import find_cusum_minimum_index, calculate_lob_gradient
+    from .algorithms import find_cusum_minimum_index, lob_gradient_numerator, population_std
     
     # Only flatten if CUSUM min <= threshold
     if cusum_min > threshold:
@@ -35,10 +37,10 @@ def create_flattened_readings(original_readings, cusum_values, cusum_min, thresh
             # Check if min_index is in first five cycles
             if min_index < 5:
                 # For first five cycles, compare with average of first two
-                avg_first = np.mean(original_readings[:2])
+                avg_first = sum(original_readings[:2]) / 2
             else:
                 # Otherwise, compare with average of first five cycles
-                avg_first = np.mean(original_readings[:5])
+                avg_first = sum(original_readings[:5]) / 5
         
         # Skip if the reading at cusum min is not lower than the early average
         if target_reading >= avg_first:
@@ -47,29 +49,24 @@ def create_flattened_readings(original_readings, cusum_values, cusum_min, thresh
     if sanity_lob:
         if lob_gradient is None:
             # Line of Best Fit sanity check: check gradient from first to CUSUM min
-            # Use readings from index 0 to min_index (inclusive)
-            x_values = np.arange(min_index + 1)
-            y_values = original_readings[:min_index + 1]
-            
-            # Calculate line of best fit
-            lob_gradient, _, _ = calculate_lob_gradient(x_values, y_values)
+            # Use readings from index 0 to min_index (inclusive); only the sign
+            # is checked, so the closed-form numerator replaces a full regression
+            lob_gradient = lob_gradient_numerator(original_readings[:min_index + 1])
         
         # Check if gradient is negative (downward trend)
         if lob_gradient >= 0:
             return None  # LOB sanity check failed, don't flatten
     
     # Determine appropriate noise scale based on data
-    reading_std = np.std(original_readings)
+    reading_std = population_std(original_readings)
     noise_scale = reading_std * 0.001  # Very small noise, 0.1% of standard deviation
     
     # Create flattened readings
-    flattened = original_readings.copy()
+    flattened = np.array(original_readings, dtype=np.float64)
     
-    # Flatten all readings before the minimum point
-    for i in range(min_index):
-        # Add small random noise to prevent identical values
-        noise = random.uniform(-noise_scale, noise_scale)
-        flattened[i] = target_reading + noise
+    # Flatten all readings before the minimum point, adding small random noise
+    # (drawn in one call) to prevent identical values
+    flattened[:min_index] = target_reading + _rng.uniform(-noise_scale, noise_scale, size=min_index)
     
     return flattened
 